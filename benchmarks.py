@@ -0,0 +1,509 @@
+#!/usr/bin/env python
+import os
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+SCRIPTS = (
+    'colorbar.py',
+    'export_surface_mesh.py',
+    'fingerprints.py',
+    'g09wrapper.py',
+    'gbs2tonto.py',
+    'tonto_hpc.py',
+)
+
+
+DEFAULT_SIZES = '10000,200000,2000000'
+DEFAULT_CACHE_ENTRIES = 2000
+CACHE_SAMPLE = 200
+
+# stand-ins for the cluster side of g09wrapper.py: ssh runs the command
+# locally, qsub runs the job before returning and qstat reports it complete
+STAND_INS = {
+    'ssh': """#!/bin/bash
+args=(); op=""
+while [ $# -gt 0 ]; do
+  case "$1" in -o) shift ;; -O) op="$2"; shift ;; -f|-N) ;; *) args+=("$1") ;; esac
+  shift
+done
+if [ -n "$op" ]; then
+  [ "$op" = check ] && [ -e "$BENCH_STAND_IN/master" ] && exit 0
+  [ "$op" = exit ] && rm -f "$BENCH_STAND_IN/master"
+  exit 1
+fi
+if [ ${#args[@]} -eq 1 ]; then touch "$BENCH_STAND_IN/master"; exit 0; fi
+exec bash -c "${args[*]:1}"
+""",
+    'scp': """#!/bin/bash
+args=()
+while [ $# -gt 0 ]; do
+  case "$1" in -o) shift ;; -*) ;; *) args+=("${1#*:}") ;; esac; shift
+done
+exec cp "${args[@]}"
+""",
+    'qsub': """#!/bin/bash
+shift 2; id=$$
+bash "$1" > /dev/null 2>&1
+echo C > "$BENCH_STAND_IN/state.$id"
+echo $id.bench
+""",
+    'qstat': """#!/bin/bash
+shift
+for id in "$@"; do
+  echo "Job Id: $id"; echo "    job_state = $(cat "$BENCH_STAND_IN/state.${id%.bench}")"
+done
+""",
+    'qdel': """#!/bin/bash
+exit 0
+""",
+    'g09': """#!/bin/bash
+echo " SCF Done:  E(RB3LYP) =  -76.4089  A.U. after   4 cycles" > "${1%.*}.log"
+echo " Normal termination of Gaussian 09" >> "${1%.*}.log"
+echo fchk > Test.FChk
+""",
+}
+
+TONTO_INPUT = """{{
+ name= {name}
+ read_g09_fchk_file "molA.fchk"
+ read_g09_fchk_file "molB.fchk"
+ atoms= {{
+ data= {{
+{atoms} }}
+ }}
+ put_group_12_energies
+}}
+"""
+
+
+def median(values):
+    values = sorted(values)
+    n = len(values)
+    return 0.5 * (values[(n - 1) // 2] + values[n // 2])
+
+
+def time_command(argv, repeat=5):
+    times = []
+    for _ in range(repeat):
+        t1 = time.perf_counter()
+        subprocess.run(argv, cwd=HERE, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - t1)
+    return median(times)
+
+
+def import_times(module):
+    # cumulative ms for the module and for each of its direct imports,
+    # from python -X importtime (which lists children before parents)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                             'import {}'.format(module)],
+                            cwd=HERE, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, universal_newlines=True)
+    children = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not cumulative.strip().isdigit():
+            continue
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        ms = int(cumulative) / 1000.0
+        if depth == 1:
+            children[name.strip()] = ms
+        elif depth == 0:
+            if name.strip() == module:
+                return ms, children
+            children = {}
+    return 0.0, {}
+
+
+def git_commit():
+    result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE,
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                            universal_newlines=True)
+    commit = result.stdout.strip() or None
+    if commit is not None:
+        dirty = subprocess.run(['git', 'diff', '--quiet', 'HEAD'], cwd=HERE,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if dirty.returncode != 0:
+            commit += '-dirty'
+    return commit
+
+
+def metadata():
+    import platform
+    import numpy as np
+    return {
+        'commit': git_commit(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def save_results(filename, results):
+    import json
+    with open(filename, 'w') as f:
+        json.dump({'meta': metadata(), 'results': results}, f, indent=1, sort_keys=True)
+    print('Wrote {} results to {}'.format(len(results), filename))
+
+
+def load_results(filename):
+    import json
+    with open(filename) as f:
+        return json.load(f)
+
+
+def write_sbf(filename, datasets):
+    # the layout lazysbf.py reads: file header, dataset headers, then the
+    # raw Fortran ordered arrays
+    import numpy as np
+    import lazysbf
+    codes = {dtype: code for code, dtype in lazysbf.SBF_DTYPES.items()}
+    header = np.zeros(1, dtype=lazysbf.FILE_HEADER)
+    header['token'] = lazysbf.SBF_FILE_TOKEN
+    header['version'] = (1, 0, 0)
+    header['n_datasets'] = len(datasets)
+    headers = np.zeros(len(datasets), dtype=lazysbf.DATASET_HEADER)
+    for h, (name, data) in zip(headers, datasets.items()):
+        h['flag'] = codes[data.dtype] | (data.ndim << lazysbf.SBF_DIMS_SHIFT)
+        h['name'] = name.encode('ascii')
+        h['shape'][:data.ndim] = data.shape
+    with open(filename, 'wb') as f:
+        f.write(header.tobytes())
+        f.write(headers.tobytes())
+        for data in datasets.values():
+            f.write(np.asfortranarray(data).tobytes(order='F'))
+
+
+def synthetic_surface(n, seed=0):
+    # a closed sphere-like surface of about n vertices with smooth,
+    # d_norm-like properties, laid out as crystalexplorer stores it
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    rows = max(int(np.sqrt(n / 2)), 3)
+    cols = max(n // rows, 3)
+    theta = np.linspace(0, np.pi, rows + 2)[1:-1]
+    phi = np.linspace(0, 2 * np.pi, cols, endpoint=False)
+    t, p = np.meshgrid(theta, phi, indexing='ij')
+    normals = np.stack([np.sin(t) * np.cos(p), np.sin(t) * np.sin(p), np.cos(t)],
+                       axis=-1).reshape(-1, 3)
+    radius = 3.0 + 0.3 * np.sin(3 * t) * np.cos(2 * p) + 0.05 * rng.random(t.shape)
+    vertices = normals * radius.reshape(-1, 1)
+    index = np.arange(rows * cols).reshape(rows, cols)
+    a, b = index[:-1], np.roll(index, -1, axis=1)[:-1]
+    c, d = index[1:], np.roll(index, -1, axis=1)[1:]
+    faces = np.concatenate([np.stack([a, c, b], axis=-1).reshape(-1, 3),
+                            np.stack([b, c, d], axis=-1).reshape(-1, 3)])
+    d_i = 1.0 + 0.6 * (1 + np.sin(2 * t + p)).ravel() / 2
+    d_e = 1.0 + 1.2 * (1 + np.cos(t - 3 * p)).ravel() / 2
+    d_norm = (d_i + d_e - 2.8) / 1.4
+    f4 = np.float32
+    return {
+        'vertices': vertices.T.astype(f4),
+        'faces': (faces.T + 1).astype(np.int32),
+        'vertex normals': normals.T.astype(f4),
+        'd_i': d_i.astype(f4),
+        'd_e': d_e.astype(f4),
+        'd_norm': d_norm.astype(f4),
+    }
+
+
+def time_call(function, repeat):
+    times = []
+    for _ in range(repeat):
+        t1 = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - t1)
+    return times
+
+
+def surface_benchmarks(directory, sizes, repeat):
+    import contextlib
+    import io
+    import lazysbf
+    from colormaps import colormap
+    from export_surface_mesh import export_surface, get_mesh
+    import fingerprints
+    from decimate import decimate
+    try:
+        import trimesh
+    except ImportError:
+        trimesh = None
+
+    for size in sizes:
+        filename = os.path.join(directory, 'surface{}.sbf'.format(size))
+        write_sbf(filename, synthetic_surface(size))
+        f = lazysbf.read_file(filename)
+        n = f['vertices'].shape[1]
+        params = {'vertices': n, 'faces': f['faces'].shape[1]}
+        for prop in ('d_norm', 'd_e'):
+            data = f[prop].data
+            yield 'colormap/{}/{}'.format(prop, size), params, time_call(
+                lambda: colormap(data, scheme=prop), repeat)
+        for fmt in ('obj', 'ply', 'glb'):
+            with contextlib.redirect_stdout(io.StringIO()):
+                times = time_call(lambda: export_surface(filename, output_format=fmt),
+                                  repeat)
+            yield 'export/{}/{}'.format(fmt, size), params, times
+        if trimesh is not None:
+            colors = colormap(f['d_norm'].data, scheme='d_norm')
+            arrays = [f[k].data.transpose() for k in ('vertices', 'faces', 'vertex normals')]
+            yield 'get_mesh/{}'.format(size), params, time_call(
+                lambda: get_mesh(arrays[0], arrays[1] - 1, arrays[2], colors), repeat)
+        yield 'fingerprint/{}'.format(size), params, time_call(
+            lambda: fingerprints.histogram(filename), repeat)
+        vertices = f['vertices'].data.transpose()
+        faces = f['faces'].data.transpose() - 1
+        yield 'decimate/{}'.format(size), dict(params, target=n // 10), time_call(
+            lambda: decimate(vertices, faces, n // 10, attributes=(f['d_norm'].data,)),
+            repeat)
+        os.remove(filename)
+        for fmt in ('obj', 'ply', 'glb'):
+            os.remove(filename[:-3] + fmt)
+
+
+def pair_input(name, shift):
+    # the same two molecules in a different relative position for each shift
+    atoms_a = [('C1', 5.0, -2.0, 1.0), ('O1', 5.917811, -1.226939, 1.0),
+               ('H1', 4.037783, -1.633751, 1.1)]
+    atoms_b = [('C1', 7.548104, 0.40773, 1.3), ('O1', 8.530337, 1.104307, 1.45)]
+    atoms = atoms_a + [(e, x + shift, y + 0.5 * shift, z) for e, x, y, z in atoms_b]
+    return TONTO_INPUT.format(name=name, atoms=''.join(
+        '  {} {:.6f} {:.6f} {:.6f}\n'.format(*atom) for atom in atoms))
+
+
+def cache_benchmarks(directory, entries, repeat):
+    import contextlib
+    import io
+    import random
+    import tonto_hpc
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        for name in ('molA.fchk', 'molB.fchk'):
+            with open(name, 'w') as f:
+                f.write('{} {}\n'.format(name, 'x' * 4096))
+        inputs = [pair_input('pair{}'.format(i), 0.01 * i) for i in range(entries)]
+        sample = min(CACHE_SAMPLE, entries)
+        # fill the cache up to the last few entries, then time those misses
+        with contextlib.redirect_stdout(io.StringIO()):
+            for contents in inputs[:-sample]:
+                tonto_hpc.check_cache(contents)
+            t1 = time.perf_counter()
+            for contents in inputs[-sample:]:
+                tonto_hpc.check_cache(contents)
+            misses = [(time.perf_counter() - t1) / sample]
+        params = {'entries': entries, 'sample': sample}
+        yield 'check_cache/miss/{}'.format(entries), params, misses
+
+        tonto_hpc.scan_index(tonto_hpc.open_index())
+        for name in os.listdir(tonto_hpc.STORAGE_DIRECTORY):
+            job = os.path.join(tonto_hpc.STORAGE_DIRECTORY, name)
+            if os.path.isfile(os.path.join(job, 'stdin')):
+                with open(os.path.join(job, 'stdout'), 'w') as f:
+                    f.write(tonto_hpc.PLACEHOLDER_STDOUT)
+        hits = random.Random(0).sample(inputs, sample)
+        # the first lookup of each records the copied in result
+        for contents in hits:
+            tonto_hpc.check_cache(contents)
+        times = []
+        for _ in range(repeat):
+            t1 = time.perf_counter()
+            for contents in hits:
+                tonto_hpc.check_cache(contents)
+            times.append((time.perf_counter() - t1) / sample)
+        yield 'check_cache/hit/{}'.format(entries), params, times
+    finally:
+        os.chdir(cwd)
+
+
+def remote_job_benchmarks(directory, repeat):
+    import logging
+    import g09wrapper
+    bin_directory = os.path.join(directory, 'bin')
+    os.mkdir(bin_directory)
+    for name, script in STAND_INS.items():
+        path = os.path.join(bin_directory, name)
+        with open(path, 'w') as f:
+            f.write(script)
+        os.chmod(path, 0o755)
+    saved_config = dict(g09wrapper.RemoteJob.config)
+    saved_environ = dict(os.environ)
+    cwd = os.getcwd()
+    g09wrapper.RemoteJob.config.update(
+        backend='pbs', remote_host='bench', transfer='scp',
+        remote_wd=os.path.join(directory, 'remote', '{job_name}'),
+        control_path=os.path.join(directory, 'control'),
+        check_status_period=0, use_scheduler=False)
+    os.environ['PATH'] = bin_directory + os.pathsep + os.environ['PATH']
+    os.environ['BENCH_STAND_IN'] = directory
+    logging.disable(logging.CRITICAL)
+    os.chdir(directory)
+    try:
+        with open('job.gjf', 'w') as f:
+            f.write('%chk=job\n# b3lyp/6-31g(d,p)\n\njob\n\n0 1\nO 0 0 0\n\n')
+
+        def round_trip():
+            job = g09wrapper.RemoteJob('job.gjf')
+            while job.running():
+                job.check_status()
+            job.download_files()
+            if job.job_status != 'C' or not os.path.exists('Test.FChk'):
+                raise RuntimeError('stand-in job did not complete')
+            os.remove('Test.FChk')
+
+        yield 'remote_job/round_trip', {'backend': 'pbs'}, time_call(round_trip, repeat)
+    finally:
+        os.chdir(cwd)
+        logging.disable(logging.NOTSET)
+        os.environ.clear()
+        os.environ.update(saved_environ)
+        g09wrapper.RemoteJob.config.clear()
+        g09wrapper.RemoteJob.config.update(saved_config)
+
+
+def hot_paths(args):
+    import shutil
+    import tempfile
+    sizes = [int(x) for x in args.sizes.split(',')]
+    groups = {
+        'surface': lambda d: surface_benchmarks(d, sizes, args.repeat),
+        'cache': lambda d: cache_benchmarks(d, args.cache_entries, args.repeat),
+        'remote': lambda d: remote_job_benchmarks(d, args.repeat),
+    }
+    results = {}
+    print('{:<32s} {:>12s} {:>12s}  {}'.format('benchmark', 'median ms', 'min ms', 'params'))
+    for group in args.only or groups:
+        directory = tempfile.mkdtemp(prefix='benchmarks-')
+        try:
+            for name, params, times in groups[group](directory):
+                results[name] = {'params': params, 'times': times,
+                                 'median': median(times), 'min': min(times)}
+                print('{:<32s} {:>12.3f} {:>12.3f}  {}'.format(
+                      name, 1000 * median(times), 1000 * min(times),
+                      ' '.join('{}={}'.format(k, v) for k, v in sorted(params.items()))))
+                sys.stdout.flush()
+        finally:
+            shutil.rmtree(directory)
+    if args.output:
+        save_results(args.output, results)
+    return 0
+
+
+def compare(args):
+    old = load_results(args.old)
+    new = load_results(args.new)
+    print('{} ({}) -> {} ({})'.format(args.old, old['meta'].get('commit'),
+                                      args.new, new['meta'].get('commit')))
+    print('{:<32s} {:>12s} {:>12s} {:>8s}'.format('benchmark', 'old ms', 'new ms', 'ratio'))
+    slower = []
+    for name in sorted(set(old['results']) | set(new['results'])):
+        if name not in old['results'] or name not in new['results']:
+            print('{:<32s} only in {}'.format(
+                  name, args.old if name in old['results'] else args.new))
+            continue
+        a = old['results'][name]['median']
+        b = new['results'][name]['median']
+        ratio = b / a if a > 0 else float('inf')
+        flag = ''
+        if ratio > 1 + args.threshold:
+            flag = 'slower'
+            slower.append(name)
+        elif ratio < 1 - args.threshold:
+            flag = 'faster'
+        print('{:<32s} {:>12.3f} {:>12.3f} {:>8.2f}  {}'.format(
+              name, 1000 * a, 1000 * b, ratio, flag))
+    if slower and args.fail:
+        print('{} benchmarks more than {:.0f}% slower'.format(
+              len(slower), 100 * args.threshold))
+        return 1
+    return 0
+
+
+def startup(args):
+    baseline = time_command([sys.executable, '-c', 'pass'], args.repeat)
+    print('python startup {:.1f} ms, times below are on top of that'.format(
+          1000 * baseline))
+    print('{:<24s} {:>10s} {:>10s}  {}'.format(
+          'script', '--help ms', 'import ms', 'heaviest imports'))
+    over_budget = []
+    results = {}
+    for script in args.scripts:
+        elapsed = 1000 * (time_command([sys.executable, script, '--help'],
+                                       args.repeat) - baseline)
+        module = os.path.splitext(script)[0]
+        own, times = import_times(module)
+        heaviest = sorted(times.items(), key=lambda x: -x[1])[:3]
+        results['startup/{}'.format(script)] = {
+            'params': {'repeat': args.repeat}, 'times': [elapsed / 1000],
+            'median': elapsed / 1000, 'min': elapsed / 1000}
+        print('{:<24s} {:>10.1f} {:>10.1f}  {}'.format(
+              script, elapsed, own,
+              ', '.join('{} {:.1f}'.format(k, v) for k, v in heaviest if v >= 1.0)))
+        if args.budget is not None and elapsed > args.budget:
+            over_budget.append(script)
+    if args.output:
+        save_results(args.output, results)
+    if over_budget:
+        print('Over the {:.0f} ms budget: {}'.format(args.budget, ', '.join(over_budget)))
+        return 1
+    return 0
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Performance checks for these scripts')
+    subparsers = parser.add_subparsers(dest='command')
+
+    p = subparsers.add_parser('startup', help='Time --help and module import for each script')
+    p.add_argument('scripts', nargs='*', default=SCRIPTS,
+                   help='Scripts to time (default: all)')
+    p.add_argument('-n', '--repeat', type=int, default=5,
+                   help='Runs per script, the median is reported')
+    p.add_argument('--budget', type=float, default=None,
+                   help='Fail if any script takes longer than this many ms '
+                        'to print --help')
+    p.add_argument('-o', '--output', help='Also write the results to this JSON file')
+    p.set_defaults(func=startup)
+
+    p = subparsers.add_parser('run', help='Time the surface, fingerprint, cache '
+                                          'and g09wrapper hot paths')
+    p.add_argument('-o', '--output', help='Write the results to this JSON file')
+    p.add_argument('--sizes', default=DEFAULT_SIZES,
+                   help='Comma separated vertex counts of the synthetic surfaces '
+                        '(default: %(default)s)')
+    p.add_argument('--cache-entries', type=int, default=DEFAULT_CACHE_ENTRIES,
+                   help='Inputs in the tonto_hpc cache for the lookup timings '
+                        '(default: %(default)s)')
+    p.add_argument('-n', '--repeat', type=int, default=3,
+                   help='Runs per benchmark, the median is reported')
+    p.add_argument('--only', action='append', choices=('surface', 'cache', 'remote'),
+                   help='Only run this group of benchmarks (may be repeated)')
+    p.set_defaults(func=hot_paths)
+
+    p = subparsers.add_parser('compare', help='Compare two JSON result files')
+    p.add_argument('old')
+    p.add_argument('new')
+    p.add_argument('--threshold', type=float, default=0.1,
+                   help='Relative change in the median counted as slower '
+                        'or faster (default: %(default)s)')
+    p.add_argument('--fail', action='store_true',
+                   help='Exit with an error if anything got slower')
+    p.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    if not hasattr(args, 'func'):
+        parser.print_help()
+        sys.exit(1)
+    sys.exit(args.func(args))
+
+
+if __name__ == '__main__':
+    main()
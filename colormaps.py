@@ -0,0 +1,192 @@
+from functools import lru_cache
+
+import numpy as np
+
+# colours are looked up in a table of this many entries along each colour
+# ramp of a scheme rather than evaluated per vertex; the nearest entry is at
+# most half a step away, so once rounded to 8 bits a colour is at most one
+# level off
+LUT_SIZE = 4096
+LUT_CACHE_SIZE = 64
+CHUNK_SIZE = 1 << 16
+
+
+RWB = np.array([[0.0, 0.0, 1.0], [1.0, 1.0, 1.0], [1.0, 0.0, 0.0]])
+RGB = np.array([[0.0, 0.0, 1.0], [0.0, 1.0, 0.0], [1.0, 0.0, 0.0]])
+
+COLORS = {
+    'd_norm': RWB,
+    'd_i': RGB,
+    'd_e': RGB,
+    'curvedness': RGB,
+    'shape_index': RGB,
+    'deformation_density': RWB,
+    'electron_density': RWB,
+    'promolecule_density': RWB,
+    'electric_potential': RWB,
+    'orbital': RWB,
+}
+
+RWB_SCHEMES = {'d_norm', 'electric_potential', 'orbital',
+               'deformation_density', 'electron_density'}
+
+
+def _float_dtype(values):
+    if np.issubdtype(values.dtype, np.floating):
+        return values.dtype
+    return np.float64
+
+
+def hsv_to_rgb(h, out):
+    # colorsys.hsv_to_rgb(h, 1.0, 1.0) for a whole array of hues
+    h6 = h * 6
+    i = np.floor(h6)
+    f = h6 - i
+    q = 1 - f
+    i = i.astype(np.intp) % 6
+    out[:, 0] = np.choose(i, (1, q, 0, 0, f, 1))
+    out[:, 1] = np.choose(i, (f, 1, 1, q, 0, 0))
+    out[:, 2] = np.choose(i, (0, 0, f, 1, 1, q))
+    return out
+
+
+def hmap(values, vmin, vmax, reverse, hmin, hmax, out=None):
+    dtype = _float_dtype(values)
+    if out is None:
+        out = np.empty((values.shape[0], 3), dtype=dtype)
+
+    range_ratio = 0.0
+    r = vmax - vmin
+    if r > 1e-6:
+        range_ratio = (hmax - hmin) / r
+
+    h = np.clip(values, vmin, vmax).astype(dtype, copy=False)
+    h -= dtype.type(vmin)
+    h *= dtype.type(range_ratio)
+    if reverse:
+        np.subtract(1, h, out=h)
+    np.clip(h, hmin, hmax, out=h)
+    return hsv_to_rgb(h, out)
+
+
+def cmap(values, vmin, vmax, start, mid, end, out=None):
+    dtype = _float_dtype(values)
+    if out is None:
+        out = np.empty((values.shape[0], 3), dtype=dtype)
+    start, mid, end = (np.asarray(c, dtype=dtype) for c in (start, mid, end))
+
+    negative = values < 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        factor = np.where(negative, values / dtype.type(vmin),
+                          values / dtype.type(vmax)).astype(dtype, copy=False)
+    np.subtract(1, factor, out=factor)
+    for channel in range(3):
+        color = np.where(negative, start[channel], end[channel])
+        out[:, channel] = color + (mid[channel] - color) * factor
+    return out
+
+
+def color_formula(prop, scheme, vmin, vmax):
+    # the colour of each value, evaluated directly
+    colors = np.empty((prop.shape[0], 3), dtype=np.float32)
+    if scheme in RWB_SCHEMES:
+        start = COLORS[scheme][0,:]
+        mid = COLORS[scheme][1,:]
+        end = COLORS[scheme][2,:]
+        cmap(prop, vmin, vmax, start, mid, end, out=colors)
+    else:
+        hmax = 240.0/359.0
+        hmin = 0.0
+        hmap(prop, vmin, vmax, False, hmin, hmax, out=colors)
+    return colors
+
+
+def _ramp_positions(values, scheme, vmin, vmax):
+    # where each value lies along its colour ramp, from 0 to 1, with nan
+    # kept: d_norm style schemes have separate ramps from 0 down to vmin and
+    # from 0 up to vmax (True in the returned mask), the others one ramp
+    # from vmin to vmax
+    dtype = _float_dtype(values)
+    u = np.array(values, dtype=dtype)
+    positive = None
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if scheme in RWB_SCHEMES:
+            positive = ~(u < 0)
+            # a select rather than masked ufuncs, which slow down a lot on
+            # values whose sign changes often
+            u *= np.where(positive, dtype.type(1 / vmax) if vmax else dtype.type(np.inf),
+                          dtype.type(1 / vmin) if vmin else dtype.type(-np.inf))
+        elif vmax - vmin > 1e-6:
+            u -= dtype.type(vmin)
+            u *= dtype.type(1 / (vmax - vmin))
+        else:
+            u *= 0
+    np.clip(u, 0, 1, out=u)
+    return u, positive
+
+
+@lru_cache(maxsize=LUT_CACHE_SIZE)
+def lookup_table(scheme, size=LUT_SIZE):
+    # colours at size evenly spaced points along each ramp of the scheme,
+    # then a row of nan for nan values. The range only decides where along
+    # the ramps a value falls, so one table serves every range. Shared
+    # between calls, so it is read only.
+    u = np.linspace(0, 1, size)
+    if scheme in RWB_SCHEMES:
+        ramps = [color_formula(-u, scheme, -1.0, 1.0), color_formula(u, scheme, -1.0, 1.0)]
+    else:
+        ramps = [color_formula(u, scheme, 0.0, 1.0)]
+    table = np.concatenate(ramps + [np.full((1, 3), np.nan, dtype=np.float32)])
+    table.setflags(write=False)
+    return table
+
+
+def property_range(values, chunk_size=CHUNK_SIZE):
+    # min and max in one pass, a cache sized chunk at a time; nan values are
+    # ignored, and the range is nan if there are no others
+    values = np.asanyarray(values).reshape(-1)
+    lo, hi = np.inf, -np.inf
+    for start in range(0, values.size, chunk_size):
+        chunk = values[start:start + chunk_size]
+        chunk_lo, chunk_hi = chunk.min(), chunk.max()
+        if np.isnan(chunk_lo):
+            valid = chunk[~np.isnan(chunk)]
+            if valid.size == 0:
+                continue
+            chunk_lo, chunk_hi = valid.min(), valid.max()
+        lo = min(lo, chunk_lo)
+        hi = max(hi, chunk_hi)
+    if lo > hi:
+        return np.nan, np.nan
+    return float(lo), float(hi)
+
+
+def merge_ranges(ranges):
+    # surfaces with no valid values have a nan range, which min and max would
+    # otherwise keep or drop depending on where it comes in the list
+    ranges = [r for r in ranges if not (np.isnan(r[0]) or np.isnan(r[1]))]
+    return (min((r[0] for r in ranges), default=np.nan),
+            max((r[1] for r in ranges), default=np.nan))
+
+
+def colormap(prop, scheme='d_norm', minval=None, maxval=None):
+    prop = np.asanyarray(prop)
+    if minval is None or maxval is None:
+        lo, hi = property_range(prop)
+        minval = lo if minval is None else minval
+        maxval = hi if maxval is None else maxval
+    vmin, vmax = float(minval), float(maxval)
+
+    table = lookup_table(scheme)
+    size = LUT_SIZE
+    colors = np.empty((prop.shape[0], 3), dtype=np.float32)
+    for start in range(0, prop.shape[0], CHUNK_SIZE):
+        end = min(start + CHUNK_SIZE, prop.shape[0])
+        u, positive = _ramp_positions(prop[start:end], scheme, vmin, vmax)
+        u *= size - 1
+        u += 0.5
+        if positive is not None:
+            u += positive * np.float32(size)
+        np.nan_to_num(u, copy=False, nan=table.shape[0] - 1)
+        np.take(table, u.astype(np.intp), axis=0, out=colors[start:end])
+    return colors
@@ -0,0 +1,130 @@
+import numpy as np
+
+# vertex clustering: the grid spacing is adjusted until the number of occupied
+# cells is within this fraction of the target vertex count
+TARGET_TOLERANCE = 0.1
+MAX_GRID_ITERATIONS = 6
+# pull towards the cluster centroid, relative to the size of the quadric, so
+# flat or nearly flat clusters still have a well defined position
+QUADRIC_REGULARIZATION = 1e-3
+
+
+def face_quadrics(vertices, faces):
+    # area weighted plane quadrics of each face as (A, b) of
+    # x^T A x + 2 b^T x + c, with A stored as its 6 unique entries
+    v0 = vertices[faces[:, 0]]
+    cross = np.cross(vertices[faces[:, 1]] - v0, vertices[faces[:, 2]] - v0)
+    length = np.linalg.norm(cross, axis=1)
+    valid = length > 0
+    n = np.zeros_like(cross)
+    n[valid] = cross[valid] / length[valid, None]
+    area = 0.5 * length
+    d = -np.einsum('ij,ij->i', n, v0)
+    x, y, z = n.T
+    a = area[:, None] * np.stack([x * x, x * y, x * z, y * y, y * z, z * z], axis=1)
+    b = (area * d)[:, None] * n
+    return a, b
+
+
+def cluster_labels(vertices, spacing):
+    cells = np.floor((vertices - vertices.min(axis=0)) / spacing).astype(np.int64)
+    dims = cells.max(axis=0) + 1
+    keys = (cells[:, 0] * dims[1] + cells[:, 1]) * dims[2] + cells[:, 2]
+    _, labels = np.unique(keys, return_inverse=True)
+    return labels.ravel(), int(labels.max()) + 1
+
+
+def surface_area(vertices, faces):
+    v0 = vertices[faces[:, 0]]
+    cross = np.cross(vertices[faces[:, 1]] - v0, vertices[faces[:, 2]] - v0)
+    return 0.5 * np.linalg.norm(cross, axis=1).sum()
+
+
+def grid_clusters(vertices, faces, target):
+    # start from the spacing that would tile the surface area with target
+    # squares, then correct by the ratio of occupied cells to the target
+    spacing = np.sqrt(max(surface_area(vertices, faces), 1e-12) / target)
+    best = None
+    for _ in range(MAX_GRID_ITERATIONS):
+        labels, count = cluster_labels(vertices, spacing)
+        if best is None or abs(count - target) < abs(best[1] - target):
+            best = labels, count, spacing
+        if abs(count - target) <= TARGET_TOLERANCE * target:
+            break
+        spacing *= np.sqrt(count / target)
+    return best
+
+
+def _sum_by_label(labels, values, count):
+    values = values.reshape(values.shape[0], -1)
+    out = np.empty((count, values.shape[1]))
+    for column in range(values.shape[1]):
+        out[:, column] = np.bincount(labels, weights=values[:, column],
+                                     minlength=count)
+    return out
+
+
+def place_vertices(vertices, faces, labels, count, spacing):
+    # each cluster's vertex goes where the sum of its faces' plane quadrics is
+    # smallest, falling back to the centroid when that is outside its cell
+    sizes = np.bincount(labels, minlength=count).astype(np.float64)
+    centroids = _sum_by_label(labels, vertices, count) / sizes[:, None]
+    a, b = face_quadrics(vertices, faces)
+    corner_labels = labels[faces].ravel()
+    a = _sum_by_label(corner_labels, np.repeat(a, 3, axis=0), count)
+    b = _sum_by_label(corner_labels, np.repeat(b, 3, axis=0), count)
+
+    upper = np.array([[0, 1, 2], [1, 3, 4], [2, 4, 5]])
+    matrices = a[:, upper]
+    trace = a[:, 0] + a[:, 3] + a[:, 5]
+    reg = QUADRIC_REGULARIZATION * trace / 3 + 1e-12
+    matrices += reg[:, None, None] * np.eye(3)
+    rhs = reg[:, None] * centroids - b
+    positions = np.linalg.solve(matrices, rhs[:, :, None])[:, :, 0]
+    outside = np.abs(positions - centroids).max(axis=1) > spacing
+    positions[outside] = centroids[outside]
+    return positions, sizes
+
+
+def collapse_faces(faces, labels):
+    faces = labels[faces]
+    keep = ((faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) &
+            (faces[:, 0] != faces[:, 2]))
+    faces = faces[keep]
+    # the same triangle can come from several original faces
+    _, first = np.unique(np.sort(faces, axis=1), axis=0, return_index=True)
+    return faces[np.sort(first)]
+
+
+def decimate(vertices, faces, target, attributes=()):
+    # vertices (N, 3), faces (M, 3) zero based; attributes are per vertex
+    # arrays (N,) or (N, k) averaged over each cluster. Returns the reduced
+    # vertices, faces and attributes.
+    vertices = np.asarray(vertices, dtype=np.float64)
+    faces = np.asarray(faces, dtype=np.int64)
+    if target >= vertices.shape[0]:
+        return vertices, faces, [np.asarray(x) for x in attributes]
+    labels, count, spacing = grid_clusters(vertices, faces, target)
+    positions, sizes = place_vertices(vertices, faces, labels, count, spacing)
+    reduced = []
+    for values in attributes:
+        values = np.asarray(values)
+        mean = _sum_by_label(labels, values.astype(np.float64), count) / sizes[:, None]
+        reduced.append(mean.reshape((count,) + values.shape[1:]).astype(values.dtype))
+    return positions, collapse_faces(faces, labels), reduced
+
+
+def vertex_normals(normals):
+    length = np.linalg.norm(normals, axis=1, keepdims=True)
+    return normals / np.where(length > 0, length, 1)
+
+
+def levels_of_detail(vertices, faces, targets, attributes=()):
+    # successive levels are reduced from the previous one, so each step only
+    # touches a mesh already close to its size
+    levels = [(vertices, faces, list(attributes))]
+    for target in sorted(targets, reverse=True):
+        if target >= levels[-1][0].shape[0]:
+            continue
+        levels.append(decimate(*levels[-1][:2], target, attributes=levels[-1][2]))
+    return levels
@@ -1,83 +1,211 @@
-import sbf
-import trimesh
-import numpy as np
-import colorsys
-
-
-RWB = np.array([[0.0, 0.0, 1.0], [1.0, 1.0, 1.0], [1.0, 0.0, 0.0]])
-RGB = np.array([[0.0, 0.0, 1.0], [0.0, 1.0, 0.0], [1.0, 0.0, 0.0]])
-
-COLORS = {
-    'd_norm': RWB,
-    'd_i': RGB,
-    'd_e': RGB,
-    'curvedness': RGB,
-    'shape_index': RGB,
-    'deformation_density': RWB,
-    'electron_density': RWB,
-    'promolecule_density': RWB,
-    'electric_potential': RWB,
-    'orbital': RWB,
-}
-
-def clamp(v, vmin, vmax):
-    return max(min(v, vmax), vmin)
-
-def hmap(value, vmin, vmax, reverse, hmin, hmax):
-    newval = clamp(value, vmin, vmax)
-
-    range_ratio = 0.0
-    r = vmax - vmin
-    if r > 1e-6:
-        range_ratio = (hmax - hmin) / r
-
-    if reverse:
-        h = 1.0 - range_ratio * (newval - vmin)
-    else:
-        h = range_ratio * (newval - vmin)
+import os
+
+import lazysbf
+from colormaps import colormap, merge_ranges, property_range
+from mesh_writers import WRITERS, write_glb, write_lod_glb, write_merged_glb
+
+# glTF attribute holding the surface property on every level of detail
+PROPERTY_ATTRIBUTE = '_PROPERTY'
+
+
+def get_mesh(verts, faces, normals, colors):
+    import trimesh
+    surface = trimesh.Trimesh(vertices=verts, faces=faces,
+                              vertex_normals=normals, vertex_colors=colors)
+    return surface
 
-    return colorsys.hsv_to_rgb(clamp(h, hmin, hmax), 1.0, 1.0)
 
-def cmap(value, vmin, vmax, start, mid, end):
-    if value < 0:
-        factor = 1.0 - value / vmin
-        color = start
+def write_level(output, output_format, vertices, faces, normals, colors, prop):
+    # faces zero based
+    if output_format == 'glb':
+        write_glb(output, vertices, faces, normals, colors,
+                  scalars={PROPERTY_ATTRIBUTE: prop})
+    elif output_format in WRITERS:
+        WRITERS[output_format](output, vertices, faces, normals, colors)
     else:
-        factor = 1.0 - value / vmax
-        color = end
-    res = color + (mid - color) * factor
-    return res
+        get_mesh(vertices, faces, normals, colors).export(output)
 
 
-def colormap(prop, scheme='d_norm', minval=None, maxval=None):
-    vmin = minval if minval else prop.min()
-    vmax = maxval if maxval else prop.max()
+def export_lods(f, name, prop, property_name, minval, maxval, output_format,
+                lod, lod_output):
+    from decimate import levels_of_detail, vertex_normals
+    # colour every level on the full resolution range so they match
+    lo, hi = property_range(prop)
+    minval = lo if minval is None else minval
+    maxval = hi if maxval is None else maxval
+    vertices = f['vertices'].data.transpose()
+    faces = f['faces'].data.transpose() - 1
+    normals = f['vertex normals'].data.transpose()
+    levels = []
+    for i, (v, fc, (n, p)) in enumerate(levels_of_detail(
+            vertices, faces, lod, attributes=(normals, prop))):
+        if i > 0:
+            v, n = v.astype(vertices.dtype), vertex_normals(n)
+        colors = colormap(p, scheme=property_name, minval=minval, maxval=maxval)
+        levels.append((v, fc, n, colors, p))
+    if lod_output == 'glb':
+        output = '{}.glb'.format(name)
+        print("Exporting {} with {} levels of detail using surface property '{}'".format(
+              output, len(levels), property_name))
+        write_lod_glb(output, [level[:4] + ({PROPERTY_ATTRIBUTE: level[4]},)
+                               for level in levels], name=os.path.basename(name))
+        return output
+    for i, level in enumerate(levels):
+        output = '{}.{}'.format(name if i == 0 else '{}.lod{}'.format(name, i),
+                                output_format)
+        print("Exporting {} ({} vertices) using surface property '{}'".format(
+              output, level[0].shape[0], property_name))
+        write_level(output, output_format, *level)
+    return '{}.{}'.format(name, output_format)
 
-    colors = np.zeros((prop.shape[0], 3), dtype=np.float32)
 
-    if scheme in {'d_norm', 'electric_potential', 'orbital',
-            'deformation_density', 'electron_density'}: 
-        start = COLORS[scheme][0,:]
-        mid = COLORS[scheme][1,:]
-        end = COLORS[scheme][2,:]
-        for i, value in enumerate(prop):
-            colors[i,:] = cmap(value, vmin, vmax, start, mid, end)
+def export_surface(filename, property_name='d_norm', minval=None, maxval=None,
+                   output_format='obj', lod=None, lod_output='files'):
+    f = lazysbf.read_file(filename)
+    prop = f[property_name].data
+    name = '.'.join(filename.split('.')[:-1])
+    if lod:
+        output = export_lods(f, name, prop, property_name, minval, maxval,
+                             output_format, lod, lod_output)
+        return output, f['vertices'].data.shape[1]
+    output = '{}.{}'.format(name, output_format)
+    print("Exporting {} using surface property '{}'".format(
+          output, property_name))
+    colors = colormap(prop, scheme=property_name,
+                      minval=minval,
+                      maxval=maxval)
+    vertices = f['vertices'].data.transpose()
+    faces = f['faces'].data.transpose()
+    normals = f['vertex normals'].data.transpose()
+    writer = WRITERS.get(output_format)
+    if writer is not None:
+        # sbf faces are 1-based, let the writer offset them chunk by chunk
+        writer(output, vertices, faces, normals, colors, index_base=1)
     else:
-        hmax = 240.0/359.0
-        hmin = 0.0
-        for i, value in enumerate(prop):
-            colors[i,:] = hmap(value, vmin, vmax, False, hmin, hmax)
-    return colors
+        mesh = get_mesh(vertices, faces - 1, normals, colors)
+        mesh.export(output)
+    return output, vertices.shape[0]
 
 
-def get_mesh(verts, faces, normals, colors):
-    surface = trimesh.Trimesh(vertices=verts, faces=faces,
-                              vertex_normals=normals, vertex_colors=colors)
-    return surface
+def dataset_range(filenames, property_name):
+    # range of a property over many surfaces in one pass, reading only that
+    # dataset of each file; unreadable files are left for the export to report
+    ranges = []
+    for filename in filenames:
+        try:
+            ranges.append(property_range(lazysbf.read_file(filename)[property_name].data))
+        except Exception:
+            continue
+    return merge_ranges(ranges)
+
+
+class ChunkColors(object):
+    # colours of a surface made a slice at a time as the writer reaches them,
+    # on the range of the whole surface
+    def __init__(self, prop, scheme, minval=None, maxval=None):
+        self.prop = prop
+        self.scheme = scheme
+        if minval is None or maxval is None:
+            lo, hi = property_range(prop)
+            minval = lo if minval is None else minval
+            maxval = hi if maxval is None else maxval
+        self.minval = minval
+        self.maxval = maxval
+        self.shape = (prop.shape[0], 3)
+
+    def __getitem__(self, index):
+        return colormap(self.prop[index], scheme=self.scheme,
+                        minval=self.minval, maxval=self.maxval)
+
+
+def surface_reader(filename, property_name, minval, maxval):
+    # opens the file again on every call, so a merged scene of many surfaces
+    # only holds the memory maps of the chunk being written
+    def read():
+        f = lazysbf.read_file(filename)
+        prop = f[property_name].data
+        return (f['vertices'].data.transpose(),
+                f['faces'].data.transpose(),
+                f['vertex normals'].data.transpose(),
+                ChunkColors(prop, property_name, minval, maxval),
+                prop)
+    return read
+
+
+def export_merged(filenames, output, property_name='d_norm', minval=None,
+                  maxval=None):
+    # every surface in one glb scene; returns (filename, vertex count) for the
+    # surfaces packed and (filename, error) for those that could not be read
+    surfaces, packed, failed, names = [], [], [], set()
+    for filename in filenames:
+        try:
+            f = lazysbf.read_file(filename)
+            prop = f[property_name].data
+            # missing datasets fail here rather than part way through the scene
+            for dataset in ('vertices', 'faces', 'vertex normals'):
+                f[dataset]
+            lo, hi = property_range(prop)
+            n_vertices = prop.shape[0]
+            del f, prop
+        except Exception as e:
+            failed.append((filename, '{}: {}'.format(type(e).__name__, e)))
+            continue
+        name = os.path.splitext(os.path.basename(filename))[0]
+        while name in names:
+            name += '_'
+        names.add(name)
+        surfaces.append((name, surface_reader(
+            filename, property_name,
+            lo if minval is None else minval, hi if maxval is None else maxval)))
+        packed.append((filename, n_vertices))
+    if surfaces:
+        print("Exporting {} surfaces to {} using surface property '{}'".format(
+              len(surfaces), output, property_name))
+        # sbf faces are 1-based
+        write_merged_glb(output, surfaces, index_base=1,
+                         property_name=PROPERTY_ATTRIBUTE)
+    return packed, failed
+
+
+def _export_worker(filename, options):
+    try:
+        return filename, export_surface(filename, **options), None
+    except Exception as e:
+        return filename, None, '{}: {}'.format(type(e).__name__, e)
+
+
+def export_surfaces(filenames, jobs=1, **options):
+    if jobs <= 1:
+        for filename in filenames:
+            yield _export_worker(filename, options)
+        return
+
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+    max_in_flight = 2 * jobs
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        in_flight = {}
+        filenames = iter(filenames)
+        while True:
+            for filename in filenames:
+                future = pool.submit(_export_worker, filename, options)
+                in_flight[future] = filename
+                if len(in_flight) >= max_in_flight:
+                    break
+            if not in_flight:
+                break
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                filename = in_flight.pop(future)
+                try:
+                    yield future.result()
+                except Exception as e:
+                    yield filename, None, '{}: {}'.format(type(e).__name__, e)
 
 
 def main():
     import argparse
+    import sys
+    import time
     parser = argparse.ArgumentParser()
     parser.add_argument('surface_files', nargs='+',
                         help='CrystalExplorer surface files in .sbf format')
@@ -89,27 +217,90 @@ def main():
     parser.add_argument('--property-max', default=None, type=float,
                         help='Maximum property value for coloring')
     parser.add_argument('--output-format', default='obj',
-                        choices=trimesh.io.export._mesh_exporters.keys(),
-                        help='Output file format')
+                        help='Output file format: {} are written directly, other '
+                             'formats trimesh can export are also accepted'.format(
+                             ', '.join(sorted(WRITERS))))
+    parser.add_argument('-j', '--jobs', default=1, type=int,
+                        help='Number of worker processes to export with')
+    parser.add_argument('--lod', default=None,
+                        help='Also write reduced levels of detail with about this many '
+                             'vertices each, comma separated (e.g. 50000,10000,2000)')
+    parser.add_argument('--lod-output', default='files', choices=('files', 'glb'),
+                        help='Write each level to its own file (name.lod1.obj etc.) or '
+                             'all levels to one glb file as MSFT_lod nodes')
+    parser.add_argument('--global-range', action='store_true',
+                        help='Color every surface on the property range of all of them, '
+                             'so colors can be compared between surfaces')
+    parser.add_argument('--merge', metavar='OUTPUT', default=None,
+                        help='Pack all surfaces into this one glb scene with shared, '
+                             'quantized vertex and index buffers')
 
     args = parser.parse_args()
-    for filename in args.surface_files:
-        f = sbf.read_file(filename)
-        prop = f[args.property].data
-        name = '.'.join(filename.split('.')[:-1])
-        output = '{}.{}'.format(name, args.output_format)
-        print("Exporting {} using surface property '{}'".format(
-              output, args.property))
-        colors = colormap(prop, scheme=args.property,
-                          minval=args.property_min,
-                          maxval=args.property_max)
-        vertices = f['vertices'].data.transpose()
-        faces = f['faces'].data.transpose() - 1
-        normals = f['vertex normals'].data.transpose()
-        mesh = get_mesh(vertices, faces, normals, colors)
-        mesh.export(output)
+    lod = None
+    if args.lod:
+        try:
+            lod = [int(x) for x in args.lod.split(',')]
+        except ValueError:
+            parser.error('argument --lod: expected comma separated vertex counts')
+        if min(lod) < 4:
+            parser.error('argument --lod: levels need at least 4 vertices')
+    if args.output_format not in WRITERS:
+        # only pay for importing trimesh when it is actually needed
+        import trimesh
+        exchange = getattr(trimesh, 'exchange', None) or trimesh.io
+        formats = sorted(set(WRITERS) | set(exchange.export._mesh_exporters))
+        if args.output_format not in formats:
+            parser.error("argument --output-format: invalid choice: '{}' (choose from {})".format(
+                         args.output_format, ', '.join(formats)))
+    if args.merge and lod:
+        parser.error('--merge cannot be combined with --lod')
+    t1 = time.time()
+    if args.global_range and (args.property_min is None or args.property_max is None):
+        lo, hi = dataset_range(args.surface_files, args.property)
+        if args.property_min is None:
+            args.property_min = lo
+        if args.property_max is None:
+            args.property_max = hi
+        print("Property '{}' ranges from {:.4f} to {:.4f} over all surfaces".format(
+              args.property, args.property_min, args.property_max))
+    if args.merge:
+        packed, failed = export_merged(args.surface_files, args.merge,
+                                       property_name=args.property,
+                                       minval=args.property_min,
+                                       maxval=args.property_max)
+        for filename, error in failed:
+            print("Failed to read {}: {}".format(filename, error), file=sys.stderr)
+        elapsed = max(time.time() - t1, 1e-9)
+        n_vertices = sum(n for _, n in packed)
+        print("Merged {} of {} surfaces ({} vertices) in {:.2f}s ({:.0f} vertices/s)".format(
+              len(packed), len(packed) + len(failed), n_vertices, elapsed,
+              n_vertices / elapsed))
+        if failed:
+            sys.exit(1)
+        return
 
+    n_files, n_vertices, failed = 0, 0, []
+    results = export_surfaces(args.surface_files, jobs=args.jobs,
+                              property_name=args.property,
+                              minval=args.property_min,
+                              maxval=args.property_max,
+                              output_format=args.output_format,
+                              lod=lod, lod_output=args.lod_output)
+    for filename, result, error in results:
+        if error is not None:
+            print("Failed to export {}: {}".format(filename, error), file=sys.stderr)
+            failed.append(filename)
+            continue
+        n_files += 1
+        n_vertices += result[1]
+    elapsed = max(time.time() - t1, 1e-9)
 
+    print("Exported {} of {} surfaces in {:.2f}s ({:.1f} files/s, {:.0f} vertices/s)".format(
+          n_files, n_files + len(failed), elapsed,
+          n_files / elapsed, n_vertices / elapsed))
+    if failed:
+        print("{} surfaces failed to export".format(len(failed)), file=sys.stderr)
+        sys.exit(1)
 
 
 if __name__ == '__main__':
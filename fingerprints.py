@@ -1,25 +1,288 @@
-import sbf
+import os
+import lazysbf
 import numpy as np
-import matplotlib.pyplot as plt
+
+# fingerprint plots are only ever saved to file
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+
+BINS = 200
+RANGE = (0.0, 2.5)
+
+INSIDE_ATOM_DATASET = 'inside atom'
+OUTSIDE_ATOM_DATASET = 'outside atom'
+ATOMIC_NUMBER_DATASET = 'atomic numbers'
+
+ELEMENTS = (
+    'X',
+    'H', 'He', 'Li', 'Be', 'B', 'C', 'N', 'O', 'F', 'Ne',
+    'Na', 'Mg', 'Al', 'Si', 'P', 'S', 'Cl', 'Ar', 'K', 'Ca',
+    'Sc', 'Ti', 'V', 'Cr', 'Mn', 'Fe', 'Co', 'Ni', 'Cu', 'Zn',
+    'Ga', 'Ge', 'As', 'Se', 'Br', 'Kr', 'Rb', 'Sr', 'Y', 'Zr',
+    'Nb', 'Mo', 'Tc', 'Ru', 'Rh', 'Pd', 'Ag', 'Cd', 'In', 'Sn',
+    'Sb', 'Te', 'I', 'Xe', 'Cs', 'Ba', 'La', 'Ce', 'Pr', 'Nd',
+    'Pm', 'Sm', 'Eu', 'Gd', 'Tb', 'Dy', 'Ho', 'Er', 'Tm', 'Yb',
+    'Lu', 'Hf', 'Ta', 'W', 'Re', 'Os', 'Ir', 'Pt', 'Au', 'Hg',
+    'Tl', 'Pb', 'Bi', 'Po', 'At', 'Rn', 'Fr', 'Ra', 'Ac', 'Th',
+    'Pa', 'U', 'Np', 'Pu', 'Am', 'Cm', 'Bk', 'Cf', 'Es', 'Fm',
+    'Md', 'No', 'Lr', 'Rf', 'Db', 'Sg', 'Bh', 'Hs', 'Mt', 'Ds',
+    'Rg', 'Cn', 'Nh', 'Fl', 'Mc', 'Lv', 'Ts', 'Og',
+)
+
+
+def bin_indices(values, bins=BINS, range=RANGE):
+    lo, hi = range
+    edges = np.linspace(lo, hi, bins + 1)
+    x = np.asarray(values, dtype=np.float64)
+    with np.errstate(invalid='ignore'):
+        idx = ((x - lo) * (bins / (hi - lo))).astype(np.intp)
+    np.clip(idx, 0, bins - 1, out=idx)
+    # correct for rounding at the bin edges the same way np.histogram does
+    idx -= x < edges[idx]
+    idx += (x >= edges[idx + 1]) & (idx != bins - 1)
+    idx[~((x >= lo) & (x <= hi))] = -1
+    return idx
+
+
+def fingerprint(de, di, bins=BINS, range=RANGE):
+    i = bin_indices(di, bins=bins, range=range)
+    j = bin_indices(de, bins=bins, range=range)
+    valid = (i >= 0) & (j >= 0)
+    flat = i[valid] * bins + j[valid]
+    counts = np.bincount(flat, minlength=bins * bins)
+    return counts.astype(np.uint32).reshape(bins, bins)
 
 
 def histogram(surface_file):
     de, di = read_de_di(surface_file)
-    return np.histogram2d(di, de, bins=200, range=((0, 2.5), (0, 2.5)))
+    edges = np.linspace(RANGE[0], RANGE[1], BINS + 1)
+    return fingerprint(de, di).astype(np.float64), edges, edges
 
 def read_de_di(surface_file):
-    f = sbf.read_file(surface_file)
+    f = lazysbf.read_file(surface_file)
     return f['d_e'].data, f['d_i'].data
 
-def main():
-    import argparse
-    parser = argparse.ArgumentParser()
-    parser.add_argument('surface_file1',
-                        help='CrystalExplorer surface file in .sbf format')
-    parser.add_argument('surface_file2',
-                        help='CrystalExplorer surface file in .sbf format')
-    args = parser.parse_args()
 
+def vertex_areas(vertices, faces):
+    # vertices (N, 3), faces (M, 3) zero based; each vertex gets a third of
+    # the area of every triangle it belongs to
+    v = vertices[faces]
+    face_areas = 0.5 * np.linalg.norm(
+        np.cross(v[:, 1] - v[:, 0], v[:, 2] - v[:, 0]), axis=1)
+    return np.bincount(faces.ravel(), weights=np.repeat(face_areas / 3, 3),
+                       minlength=vertices.shape[0])
+
+
+def element_pairs(surface_file, inside=INSIDE_ATOM_DATASET,
+                  outside=OUTSIDE_ATOM_DATASET,
+                  atomic_numbers=ATOMIC_NUMBER_DATASET):
+    f = lazysbf.read_file(surface_file)
+    zi = np.asarray(f[inside].data, dtype=np.intp).ravel()
+    ze = np.asarray(f[outside].data, dtype=np.intp).ravel()
+    # per vertex values are (1-based) atom indices into the atom list, which
+    # can't be labelled by element without the atomic numbers of the atoms
+    if atomic_numbers not in f:
+        raise ValueError("no '{}' dataset to look up the elements of atoms".format(
+                         atomic_numbers))
+    z = np.asarray(f[atomic_numbers].data, dtype=np.intp).ravel()
+    if min(zi.min(), ze.min()) < 1 or max(zi.max(), ze.max()) > z.size:
+        raise ValueError('atom indices outside the {} atoms in {!r}'.format(
+                         z.size, atomic_numbers))
+    if z.min() < 0 or z.max() >= len(ELEMENTS):
+        raise ValueError('atomic numbers outside 0-{} in {!r}'.format(
+                         len(ELEMENTS) - 1, atomic_numbers))
+    return f, z[zi - 1], z[ze - 1]
+
+
+def decompose(surface_file, reciprocal=False, **datasets):
+    f, zi, ze = element_pairs(surface_file, **datasets)
+    if reciprocal:
+        zi, ze = np.minimum(zi, ze), np.maximum(zi, ze)
+    n_elements = len(ELEMENTS)
+    codes = zi * n_elements + ze
+    present = np.flatnonzero(np.bincount(codes, minlength=n_elements ** 2))
+    lookup = np.full(n_elements ** 2, -1, dtype=np.intp)
+    lookup[present] = np.arange(present.size)
+    pair = lookup[codes]
+
+    i = bin_indices(f['d_i'].data)
+    j = bin_indices(f['d_e'].data)
+    valid = (i >= 0) & (j >= 0)
+    flat = (pair[valid] * BINS + i[valid]) * BINS + j[valid]
+    histograms = np.bincount(flat, minlength=present.size * BINS * BINS)
+    histograms = histograms.astype(np.uint32).reshape(present.size, BINS, BINS)
+
+    vertices = f['vertices'].data.transpose()
+    faces = f['faces'].data.transpose() - 1
+    areas = np.bincount(pair, weights=vertex_areas(vertices, faces),
+                        minlength=present.size)
+    percentages = 100 * areas / max(areas.sum(), 1e-12)
+
+    labels = ['{}···{}'.format(ELEMENTS[c // n_elements], ELEMENTS[c % n_elements])
+              for c in present]
+    return labels, histograms, percentages
+
+
+def _fingerprint_worker(surface_file):
+    try:
+        return fingerprint(*read_de_di(surface_file)), None
+    except Exception as e:
+        return None, '{}: {}'.format(type(e).__name__, e)
+
+
+def batch_fingerprints(surface_files, jobs=None):
+    if jobs == 1:
+        return _collect(surface_files, map(_fingerprint_worker, surface_files))
+
+    from concurrent.futures import ProcessPoolExecutor
+    jobs = jobs or os.cpu_count() or 1
+    chunksize = max(1, min(64, len(surface_files) // (4 * jobs)))
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        results = pool.map(_fingerprint_worker, surface_files, chunksize=chunksize)
+        return _collect(surface_files, results)
+
+
+def _collect(surface_files, results):
+    # successful rows are packed to the front as they arrive; np.zeros pages
+    # are only committed when written, so the unused tail costs no memory
+    histograms = np.zeros((len(surface_files), BINS, BINS), dtype=np.uint32)
+    names, errors = [], {}
+    for filename, (counts, error) in zip(surface_files, results):
+        if error is not None:
+            errors[filename] = error
+        else:
+            histograms[len(names)] = counts
+            names.append(filename)
+    return histograms[:len(names)], names, errors
+
+
+def save_fingerprints(filename, histograms, surface_files, failed=()):
+    np.savez_compressed(filename, histograms=histograms,
+                        filenames=np.array(surface_files, dtype=str),
+                        failed=np.array(sorted(failed), dtype=str),
+                        bins=BINS, range=np.array(RANGE))
+
+
+def load_fingerprints(filename):
+    with np.load(filename) as f:
+        return f['histograms'], list(f['filenames'])
+
+
+def _normalised(histograms, mask=None):
+    h = histograms.reshape(histograms.shape[0], -1)
+    totals = h.sum(axis=1, keepdims=True).astype(np.float32)
+    totals[totals == 0] = 1
+    if mask is not None:
+        h = h[:, mask]
+    return h.astype(np.float32) / totals
+
+
+def _pca_components(sample, n_components, seed=0, n_iter=2):
+    # randomized range finder (Halko et al. 2011) on the centred sample
+    rng = np.random.default_rng(seed)
+    X = sample - sample.mean(axis=0)
+    n_components = min(n_components, *X.shape)
+    Q = X @ rng.standard_normal((X.shape[1], n_components + 10)).astype(X.dtype)
+    for _ in range(n_iter):
+        Q, _ = np.linalg.qr(Q)
+        Q, _ = np.linalg.qr(X @ (X.T @ Q))
+    _, _, vt = np.linalg.svd(Q.T @ X, full_matrices=False)
+    return vt[:n_components].astype(np.float32)
+
+
+def build_index(stack_files, n_components=128, sample_size=2000, seed=0):
+    counts = []
+    for stack_file in stack_files:
+        with np.load(stack_file) as f:
+            counts.append(len(f['filenames']))
+    rng = np.random.default_rng(seed)
+    keep = rng.random(sum(counts)) < sample_size / max(sum(counts), 1)
+
+    # first pass: which bins are ever populated, and a sample to fit the PCA on
+    mask = np.zeros(BINS * BINS, dtype=bool)
+    sample, offset = [], 0
+    for stack_file, n in zip(stack_files, counts):
+        histograms, _ = load_fingerprints(stack_file)
+        mask |= histograms.reshape(n, -1).any(axis=0)
+        rows = np.flatnonzero(keep[offset:offset + n])
+        if n_components and rows.size:
+            sample.append(_normalised(histograms[rows]))
+        offset += n
+
+    components = None
+    if sample:
+        sample = np.concatenate(sample)
+        # unpopulated bins are zero in every sample so carry no weight
+        components = _pca_components(sample, n_components, seed=seed)[:, mask]
+        components = np.ascontiguousarray(components)
+        del sample
+
+    filenames, vectors = [], []
+    for stack_file in stack_files:
+        histograms, names = load_fingerprints(stack_file)
+        filenames.extend(names)
+        for start in range(0, histograms.shape[0], 4096):
+            v = _normalised(histograms[start:start + 4096], mask)
+            if components is not None:
+                v = v @ components.T
+            vectors.append(v)
+    width = mask.sum() if components is None else components.shape[0]
+    vectors = np.concatenate(vectors) if vectors else np.zeros((0, width), np.float32)
+    return {
+        'vectors': vectors,
+        'norms': np.linalg.norm(vectors, axis=1),
+        'filenames': np.array(filenames, dtype=str),
+        'mask': mask,
+        'components': components if components is not None else np.zeros((0, 0), np.float32),
+    }
+
+
+def save_index(filename, index):
+    np.savez(filename, **index)
+
+
+def load_index(filename):
+    with np.load(filename) as f:
+        return {k: f[k] for k in f.files}
+
+
+def index_vectors(index, histograms):
+    v = _normalised(histograms, index['mask'])
+    if index['components'].size:
+        v = v @ index['components'].T
+    return v
+
+
+METRICS = ('l1', 'l2', 'cosine')
+
+
+def distances(index, query, metric='l1', chunk_size=16384):
+    vectors, norms = index['vectors'], index['norms']
+    if metric == 'l1':
+        d = np.empty(vectors.shape[0], dtype=np.float32)
+        for start in range(0, vectors.shape[0], chunk_size):
+            chunk = vectors[start:start + chunk_size]
+            d[start:start + chunk_size] = np.abs(chunk - query).sum(axis=1)
+        return d
+    dots = vectors @ query
+    q_norm = np.linalg.norm(query)
+    if metric == 'l2':
+        return np.sqrt(np.maximum(norms ** 2 - 2 * dots + q_norm ** 2, 0))
+    if metric == 'cosine':
+        return np.maximum(1 - dots / np.maximum(norms * q_norm, 1e-12), 0)
+    raise ValueError('Unknown metric: {}'.format(metric))
+
+
+def nearest(index, query, k=10, metric='l1'):
+    d = distances(index, query, metric=metric)
+    k = min(k, d.shape[0])
+    top = np.argpartition(d, k - 1)[:k] if k < d.shape[0] else np.arange(d.shape[0])
+    top = top[np.argsort(d[top], kind='stable')]
+    return [(index['filenames'][i], float(d[i])) for i in top]
+
+
+def compare(args):
+    import matplotlib.pyplot as plt
     fig, axes = plt.subplots(3, 1)
     fig.set_size_inches(4, 12)
     H1, xedges, yedges = histogram(args.surface_file1)
@@ -38,5 +301,149 @@ def main():
         ax.set_ylabel(r'$d_e$')
     plt.savefig('fingerprint.png', dpi=300, bbox_inches='tight')
 
+
+def batch(args):
+    import sys
+    import time
+    t1 = time.time()
+    histograms, surface_files, errors = batch_fingerprints(
+        args.surface_files, jobs=args.jobs)
+    for filename, error in errors.items():
+        print('Failed to read {}: {}'.format(filename, error), file=sys.stderr)
+    save_fingerprints(args.output, histograms, surface_files, failed=errors)
+    elapsed = max(time.time() - t1, 1e-9)
+    print('Wrote {} fingerprints to {} in {:.2f}s ({:.1f} files/s)'.format(
+          len(surface_files), args.output, elapsed, len(surface_files) / elapsed))
+
+
+def make_index(args):
+    import time
+    t1 = time.time()
+    index = build_index(args.fingerprints, n_components=args.components,
+                        sample_size=args.sample)
+    save_index(args.output, index)
+    print('Indexed {} fingerprints ({} dimensions) into {} in {:.2f}s'.format(
+          index['vectors'].shape[0], index['vectors'].shape[1],
+          args.output, time.time() - t1))
+
+
+def query(args):
+    import time
+    index = load_index(args.index)
+    names = {name: i for i, name in enumerate(index['filenames'])}
+    for target in args.targets:
+        t1 = time.time()
+        if target in names:
+            q = index['vectors'][names[target]]
+        else:
+            de, di = read_de_di(target)
+            q = index_vectors(index, fingerprint(de, di)[np.newaxis])[0]
+        results = nearest(index, q, k=args.k, metric=args.metric)
+        print('{} ({} distance, {:.1f} ms)'.format(
+              target, args.metric, 1000 * (time.time() - t1)))
+        for rank, (name, d) in enumerate(results, 1):
+            print('{:4d} {:12.6f} {}'.format(rank, d, name))
+
+
+def decomposed(args):
+    import sys
+    failed = 0
+    for surface_file in args.surface_files:
+        try:
+            labels, histograms, percentages = decompose(
+                surface_file, reciprocal=args.reciprocal, inside=args.inside,
+                outside=args.outside, atomic_numbers=args.atomic_numbers)
+        except (KeyError, ValueError) as e:
+            print('Failed to decompose {}: {}'.format(surface_file, e), file=sys.stderr)
+            failed += 1
+            continue
+        output = os.path.splitext(surface_file)[0] + '_decomposed.npz'
+        np.savez_compressed(output, histograms=histograms,
+                            pairs=np.array(labels, dtype=str),
+                            area_percent=percentages,
+                            bins=BINS, range=np.array(RANGE))
+        print(surface_file)
+        for k in np.argsort(-percentages, kind='stable'):
+            print('  {:<10s} {:6.1f}%'.format(labels[k], percentages[k]))
+        print('  written to {}'.format(output))
+    if failed:
+        sys.exit(1)
+
+
+SUBCOMMANDS = ('compare', 'batch', 'index', 'query', 'decompose')
+
+
+def main():
+    import argparse
+    import sys
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+
+    p = subparsers.add_parser('compare',
+                              help='Plot fingerprints of two surfaces and their difference')
+    p.add_argument('surface_file1',
+                   help='CrystalExplorer surface file in .sbf format')
+    p.add_argument('surface_file2',
+                   help='CrystalExplorer surface file in .sbf format')
+    p.set_defaults(func=compare)
+
+    p = subparsers.add_parser('batch',
+                              help='Compute fingerprint histograms for many surfaces')
+    p.add_argument('surface_files', nargs='+',
+                   help='CrystalExplorer surface files in .sbf format')
+    p.add_argument('-o', '--output', default='fingerprints.npz',
+                   help='Output file for the stacked histograms')
+    p.add_argument('-j', '--jobs', default=None, type=int,
+                   help='Number of worker processes (default: all cores)')
+    p.set_defaults(func=batch)
+
+    p = subparsers.add_parser('index',
+                              help='Build a similarity index over batch fingerprint files')
+    p.add_argument('fingerprints', nargs='+',
+                   help='Stacked fingerprint files written by the batch subcommand')
+    p.add_argument('-o', '--output', default='fingerprint_index.npz',
+                   help='Output index file')
+    p.add_argument('--components', default=128, type=int,
+                   help='Number of principal components to keep (0 keeps all bins)')
+    p.add_argument('--sample', default=2000, type=int,
+                   help='Number of fingerprints sampled to fit the components')
+    p.set_defaults(func=make_index)
+
+    p = subparsers.add_parser('query',
+                              help='Find the nearest fingerprints in an index')
+    p.add_argument('index', help='Index file written by the index subcommand')
+    p.add_argument('targets', nargs='+',
+                   help='Surface files in .sbf format or filenames in the index')
+    p.add_argument('-k', default=10, type=int,
+                   help='Number of neighbours to report')
+    p.add_argument('--metric', default='l1', choices=METRICS,
+                   help='Distance metric used to rank fingerprints')
+    p.set_defaults(func=query)
+
+    p = subparsers.add_parser('decompose',
+                              help='Fingerprints and area percentages per element pair')
+    p.add_argument('surface_files', nargs='+',
+                   help='CrystalExplorer surface files in .sbf format')
+    p.add_argument('--reciprocal', action='store_true',
+                   help='Combine A···B and B···A contacts')
+    p.add_argument('--inside', default=INSIDE_ATOM_DATASET,
+                   help='Dataset with the atom inside the surface at each vertex')
+    p.add_argument('--outside', default=OUTSIDE_ATOM_DATASET,
+                   help='Dataset with the atom outside the surface at each vertex')
+    p.add_argument('--atomic-numbers', default=ATOMIC_NUMBER_DATASET,
+                   help='Dataset with the atomic number of each atom, indexed by '
+                        'the inside and outside atom datasets')
+    p.set_defaults(func=decomposed)
+
+    argv = sys.argv[1:]
+    # fingerprints.py a.sbf b.sbf is shorthand for the compare subcommand
+    if argv and argv[0] not in SUBCOMMANDS and not argv[0].startswith('-'):
+        argv = ['compare'] + argv
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        sys.exit(1)
+    args.func(args)
+
 if __name__ == '__main__':
     main()
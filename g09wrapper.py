@@ -4,14 +4,233 @@ import sys
 import logging
 import argparse
 import time
+import os
+import socket
+import socketserver
+import threading
+import hashlib
+import shlex
+import shutil
 
 LOG = logging.getLogger('g09wrapper')
 LOG.setLevel(logging.DEBUG)
 
-class RemoteJob(object):
+
+def file_checksum(filename, blocksize=1 << 20):
+    if not os.path.exists(filename):
+        return None
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def log_file_contents(filename, chunk_lines=1000):
+    # log in chunks rather than reading the whole file into memory
+    LOG.info('Log contents (%s):', filename)
+    with open(filename, errors='replace') as f:
+        lines = []
+        for line in f:
+            lines.append(line)
+            if len(lines) == chunk_lines:
+                LOG.info('\n%s', ''.join(lines).rstrip('\n'))
+                lines = []
+        if lines:
+            LOG.info('\n%s', ''.join(lines).rstrip('\n'))
+
+
+class GaussianLogMonitor(object):
+    # Follows a Gaussian log as it is written, tracking SCF progress and
+    # spotting error terminations before the batch system reports the job done.
+    failure_markers = (
+        'Error termination',
+        'Convergence failure -- run terminated.',
+    )
+    # lines that put an error termination down to the machine rather than the
+    # input, so running the same input again can succeed
+    transient_markers = (
+        'Erroneous write',  # scratch full or an I/O error on the node
+        'Erroneous read',
+        'No space left on device',
+        'Disk quota exceeded',
+    )
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.scf_cycles = 0
+        self.scf_energies = []
+        self.failure = None
+        self.transient = None
+        self.normal_termination = False
+        self.last_update = self.start_time
+        self.partial = b''
+
+    def feed(self, data):
+        lines = (self.partial + data).split(b'\n')
+        self.partial = lines.pop()
+        for line in lines:
+            self.parse_line(line.decode('latin-1'))
+        if lines:
+            self.last_update = time.time()
+
+    def parse_line(self, line):
+        stripped = line.strip()
+        if self.transient is None and any(m in stripped for m in self.transient_markers):
+            self.transient = stripped
+        if stripped.startswith('Cycle '):
+            self.scf_cycles += 1
+        elif stripped.startswith('SCF Done:'):
+            tokens = stripped.split('=')[1].split()
+            self.scf_energies.append(float(tokens[0]))
+            LOG.info('SCF converged: E = %s after %s cycles (%.0fs elapsed)',
+                     tokens[0], tokens[-2], time.time() - self.start_time)
+        elif stripped.startswith('Normal termination'):
+            self.normal_termination = True
+        elif any(stripped.startswith(m) for m in self.failure_markers):
+            if self.failure is None:
+                self.failure = stripped
+                LOG.error('Gaussian failure detected: %s', stripped)
+
+    def progress(self):
+        elapsed = time.time() - self.start_time
+        per_cycle = elapsed / self.scf_cycles if self.scf_cycles else float('nan')
+        energy = self.scf_energies[-1] if self.scf_energies else None
+        return ('{} SCF cycles, last SCF energy {}, {:.0f}s elapsed '
+                '({:.1f}s per cycle)'.format(self.scf_cycles, energy, elapsed, per_cycle))
+
+
+# One multiplexed ssh master connection shared by every ssh and scp call. The
+# master stays up for control_persist after its last use, so later wrapper
+# invocations against the same host reuse it too.
+class SSHConnection(object):
+
+    def __init__(self, host, control_path='~/.ssh/g09wrapper-%C',
+                 control_persist='30m'):
+        self.host = host
+        self.control_path = os.path.expanduser(control_path)
+        self.control_persist = control_persist
+
+    def options(self, control_master='auto'):
+        # ssh takes the first value given for an option, so the master is
+        # started with its own options rather than by adding ControlMaster=yes
+        return ['-o', 'ControlMaster={}'.format(control_master),
+                '-o', 'ControlPath={}'.format(self.control_path),
+                '-o', 'ControlPersist={}'.format(self.control_persist)]
+
+    def master_running(self):
+        cmd = ['ssh'] + self.options() + ['-O', 'check', self.host]
+        return subprocess.call(cmd, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL) == 0
+
+    def start(self):
+        if self.master_running():
+            return True
+        LOG.debug('Starting ssh control master for %s', self.host)
+        cmd = ['ssh'] + self.options(control_master='yes') + ['-f', '-N', self.host]
+        return subprocess.call(cmd) == 0
+
+    def close(self):
+        cmd = ['ssh'] + self.options() + ['-O', 'exit', self.host]
+        subprocess.call(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def run(self, command, text=True):
+        cmd = ['ssh'] + self.options() + [self.host, command]
+        return subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              universal_newlines=text)
+
+    def copy(self, sources, destination, compress=True):
+        cmd = ['scp'] + (['-C'] if compress else []) + self.options()
+        cmd += list(sources) + [destination]
+        return subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              universal_newlines=True)
+
+    def sync(self, sources, destination, compress=True):
+        # rsync skips files whose checksum already matches and sends only the
+        # changed blocks of the rest, over the same control master
+        ssh = ' '.join(shlex.quote(x) for x in ['ssh'] + self.options())
+        cmd = ['rsync', '--checksum', '--times', '--partial', '-e', ssh]
+        cmd += (['--compress'] if compress else []) + list(sources) + [destination]
+        return subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              universal_newlines=True)
+
+    def has_rsync(self):
+        if shutil.which('rsync') is None:
+            return False
+        return self.run('command -v rsync').returncode == 0
+
+    def remote(self, path):
+        return '{}:{}'.format(self.host, path)
+
+
+# Runs "remote" commands and copies on this machine, for the local backend.
+class LocalConnection(object):
+    host = 'localhost'
+
+    def start(self):
+        return True
+
+    def close(self):
+        pass
+
+    def run(self, command, text=True):
+        return subprocess.run(['bash', '-c', command], stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE, universal_newlines=text)
+
+    def copy(self, sources, destination, compress=False):
+        # paths such as remote_wd may use $USER or ~ like the commands run
+        # through bash do
+        expand = lambda path: os.path.expanduser(os.path.expandvars(path))
+        cmd = ['cp'] + [expand(s) for s in sources] + [expand(destination)]
+        return subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              universal_newlines=True)
+
+    def has_rsync(self):
+        return False
+
+    def remote(self, path):
+        return path
+
+
+class BatchBackend(object):
+    commands = {}
+    job_script = ''
+    waiting_states = set()
+    complete_states = set()
+    # state reported for a job the batch system no longer knows about, or
+    # None to keep waiting for it to show up
+    missing_state = None
+
+    def job_key(self, job_id):
+        return job_id
+
+    def parse_job_id(self, output):
+        return output.strip()
+
+    def submit_command(self, job_name, job_file):
+        return self.commands['submit'].format(job_name=job_name, job_file=job_file)
+
+    def status_command(self, job_ids):
+        return self.commands['check_status'].format(job_ids=' '.join(job_ids))
+
+    def cancel_command(self, job_id):
+        return self.commands['cancel'].format(job_id=job_id)
+
+    def parse_status(self, output):
+        states = {}
+        for line in output.splitlines():
+            tokens = line.split()
+            if len(tokens) >= 2:
+                states[self.job_key(tokens[0])] = tokens[1]
+        return states
+
+
+class PBSBackend(BatchBackend):
     commands = {
         'submit': 'qsub -N {job_name} {job_file}',
-        'check_status': "qstat -f {job_id} | awk '/job_state/ {{print $NF}}' ",
+        'check_status': "qstat -f {job_ids} 2>/dev/null | "
+                        "awk '/Job Id:/ {{id=$3}} /job_state/ {{print id, $NF}}'",
+        'cancel': 'qdel {job_id}',
     }
 
     job_script = """#!/bin/bash
@@ -31,15 +250,128 @@ pwd
 exit $?
 """
 
+    waiting_states = {'R', 'Q'}
+    complete_states = {'C', 'E'}
+    missing_state = 'C'
+
+    def job_key(self, job_id):
+        # qsub and qstat -f do not always agree on the server part of the id
+        return job_id.split('.')[0]
+
+
+class SlurmBackend(BatchBackend):
+    commands = {
+        'submit': 'sbatch --parsable -J {job_name} {job_file}',
+        'check_status': 'sacct -n -P -X -o JobID,State -j {job_ids}',
+        'cancel': 'scancel {job_id}',
+    }
+
+    job_script = """#!/bin/bash
+#SBATCH --time=01:00:00
+#SBATCH --mem=32G
+#SBATCH --nodes=1
+#SBATCH --ntasks=1
+#SBATCH --cpus-per-task=16
+
+# module load gaussian
+
+export GAUSS_MDEF=30GB
+export GAUSS_CDEF=0-15
+
+cd {remote_wd}
+pwd
+{g09_command} {filename}
+exit $?
+"""
+
+    waiting_states = {'PENDING', 'RUNNING', 'CONFIGURING', 'COMPLETING',
+                      'REQUEUED', 'RESIZING', 'SUSPENDED'}
+    complete_states = {'COMPLETED', 'FAILED', 'CANCELLED', 'TIMEOUT',
+                       'OUT_OF_MEMORY', 'NODE_FAIL', 'PREEMPTED', 'BOOT_FAIL',
+                       'DEADLINE'}
+
+    def job_key(self, job_id):
+        # --parsable prints jobid;cluster on multi-cluster setups
+        return job_id.split(';')[0]
+
+    def parse_job_id(self, output):
+        return self.job_key(output.strip())
+
+    def status_command(self, job_ids):
+        return self.commands['check_status'].format(job_ids=','.join(job_ids))
+
+    def parse_status(self, output):
+        states = {}
+        for line in output.splitlines():
+            tokens = line.strip().split('|')
+            if len(tokens) >= 2 and tokens[1]:
+                # e.g. 'CANCELLED by 1234'
+                states[self.job_key(tokens[0])] = tokens[1].split()[0]
+        return states
+
+
+class LocalBackend(BatchBackend):
+    # Runs the job script as a background process on this machine, mostly so
+    # the submit/poll/download path can be exercised without a cluster.
+    commands = {
+        'submit': 'nohup bash {job_file} > {job_name}.out 2>&1 < /dev/null & echo $!',
+        'check_status': 'for id in {job_ids}; do '
+                        'if kill -0 $id 2>/dev/null; then echo $id R; '
+                        'else echo $id C; fi; done',
+        'cancel': 'kill {job_id}',
+    }
+
+    job_script = """#!/bin/bash
+cd {remote_wd}
+{g09_command} {filename}
+exit $?
+"""
+
+    waiting_states = {'R'}
+    complete_states = {'C'}
+    missing_state = 'C'
+
+
+BACKENDS = {
+    'pbs': PBSBackend,
+    'slurm': SlurmBackend,
+    'local': LocalBackend,
+}
+
+
+def make_connection(config):
+    if config['backend'] == 'local':
+        return LocalConnection()
+    return SSHConnection(config['remote_host'],
+                         control_path=config['control_path'],
+                         control_persist=config['control_persist'])
+
+
+class RemoteJob(object):
     config = {
+        'backend': 'pbs', # one of BACKENDS: pbs, slurm or local
+        'g09_command': 'g09',
         'remote_host': '',
         'remote_test_command': 'hostname',
         'remote_wd': '/scratch/$USER/{job_name}',
         'remote_wd_setup': 'mkdir -p {remote_wd}',
         'remote_job_submit': 'cd {remote_wd} && {submit_command}',
         'check_status_period': 30, # seconds between checking in
-        'waiting_states': {'R', 'Q'},
-        'complete_states': {'C', 'E'}
+        'control_path': '~/.ssh/g09wrapper-%C', # ssh ControlPath for the shared connection
+        'control_persist': '30m', # keep the shared connection open this long when idle
+        'transfer': 'auto', # rsync, scp, or auto to use rsync when both ends have it
+        'compress_transfers': True,
+        'tail_log': True, # follow the Gaussian log while the job runs
+        'on_failure': 'cancel', # cancel, or resubmit a job whose log shows a transient error termination
+        'max_resubmits': 1,
+        'use_scheduler': True, # wait on the local scheduler daemon if it is running
+        'scheduler_socket': '~/.g09wrapper/scheduler.sock',
+        'scheduler_min_period': 5, # seconds between batched status checks...
+        'scheduler_max_period': 120, # ...backing off to this when nothing changes
+        'scheduler_backoff': 1.5,
+        'scheduler_missing_polls': 2, # status polls a job may be absent from the queue before it counts as done
+        'scheduler_idle_timeout': 3600, # daemon exits after this long with no jobs
+        'scheduler_forget_after': 600, # finished jobs no wrapper has collected are dropped after this long
     }
 
     job_id = None
@@ -49,164 +381,473 @@ exit $?
     job_inputs = []
     job_outputs = []
     working_directory = None
+    failed = False
+    resubmits = 0
+    missing_polls = 0
 
     def __init__(self, input_filename):
 
-        if not self.config['remote_host']:
+        if not self.config['remote_host'] and self.config['backend'] != 'local':
             LOG.error('Please edit the script file to set '
                       'variables such as remote host etc.')
             sys.exit(1)
 
+        self.backend = BACKENDS[self.config['backend']]()
+        self.connection = make_connection(self.config)
+        self.connection.start()
         self.connection_valid = self.check_connection()
+        # local jobs are always copied with cp
+        self.use_rsync = (self.config['backend'] != 'local' and
+                          (self.config['transfer'] == 'rsync' or
+                           (self.config['transfer'] == 'auto' and self.connection.has_rsync())))
+        self.scheduler = None
+        if self.config['use_scheduler']:
+            self.scheduler = SchedulerClient.connect(self.config['scheduler_socket'])
         self.job_name = input_filename[:-4] # remove suffix
         self.job_file = self.job_name+'.jobfile'
         self.working_directory = self.config['remote_wd'].format(job_name=self.job_name)
         self.job_inputs = [input_filename, self.job_file]
         self.setup_job_outputs()
 
-        self.jobfile_contents = self.job_script.format(
+        self.jobfile_contents = self.backend.job_script.format(
                 filename=input_filename,
-                g09_command='g09',
+                g09_command=self.config['g09_command'],
                 remote_wd=self.working_directory)
         with open(self.job_file, 'w') as f:
             f.write(self.jobfile_contents)
         self.submit_job()
 
     def setup_job_outputs(self):
-        fmt_string = '{remote_host}:{remote_wd}/{{f}}'.format(
-                remote_host=self.config['remote_host'],
-                remote_wd=self.working_directory)
-        self.job_outputs = [fmt_string.format(f=f) for f in (self.job_name+'.log', 'Test.FChk')]
+        self.job_outputs = [self.connection.remote('{}/{}'.format(self.working_directory, f))
+                            for f in (self.job_name+'.log', 'Test.FChk')]
 
     def connect_and_execute(self, command):
-        cmd = ["ssh", self.config['remote_host'], command]
-        ssh = subprocess.Popen(cmd, shell=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        ssh.wait()
+        ssh = self.connection.run(command)
         if not ssh.returncode == 0:
             LOG.error("Remote command '%s' exit status = %d", command, ssh.returncode)
-            LOG.error("stderr:\n%s", ssh.stderr.read())
+            LOG.error("stderr:\n%s", ssh.stderr)
             sys.exit(ssh.returncode)
         return ssh
 
+    def copy_files(self, sources, destination, description):
+        compress = self.config['compress_transfers']
+        if self.use_rsync:
+            scp = self.connection.sync(sources, destination, compress=compress)
+        else:
+            scp = self.connection.copy(sources, destination, compress=compress)
+        if not scp.returncode == 0:
+            LOG.error("Copying files '%s' %s exit status = %d",
+                      sources, description, scp.returncode)
+            LOG.error("stderr:\n%s", scp.stderr)
+            sys.exit(scp.returncode)
+        return scp
+
+    def remote_checksums(self, filenames):
+        # sha1 of files in the remote working directory, keyed by basename
+        paths = ' '.join('{}/{}'.format(self.working_directory, shlex.quote(f))
+                         for f in filenames)
+        result = self.connection.run('sha1sum {} 2>/dev/null'.format(paths))
+        checksums = {}
+        for line in result.stdout.splitlines():
+            tokens = line.split(None, 1)
+            if len(tokens) == 2:
+                checksums[os.path.basename(tokens[1].strip())] = tokens[0]
+        return checksums
+
+    def changed_files(self, local_files, remote_names):
+        # (local, remote) pairs whose content differs; rsync does this itself
+        if self.use_rsync:
+            return list(zip(local_files, remote_names))
+        remote = self.remote_checksums(remote_names)
+        changed = []
+        for local, name in zip(local_files, remote_names):
+            digest = file_checksum(local)
+            if digest is None or remote.get(name) != digest:
+                changed.append((local, name))
+        return changed
+
 
     def running(self):
-        return ((self.job_status not in self.config['complete_states']) 
-                and (self.connection_valid))
+        return ((self.job_status not in self.backend.complete_states)
+                and (self.connection_valid) and not self.failed)
+
+    def tail_log(self):
+        # fetch only the bytes of the remote log written since the last poll
+        log_path = '{}/{}.log'.format(self.working_directory, self.job_name)
+        result = self.connection.run('tail -c +{} {} 2>/dev/null'.format(
+            self.log_offset + 1, log_path), text=False)
+        data = result.stdout
+        if not data:
+            return
+        self.log_offset += len(data)
+        with open('remote.log', 'ab') as f:
+            f.write(data)
+        self.log_monitor.feed(data)
+        LOG.info('Progress: %s', self.log_monitor.progress())
+        if self.log_monitor.failure is not None:
+            self.handle_failure()
+
+    def handle_failure(self):
+        LOG.info('Cancelling job %s', self.job_id)
+        self.connection.run(self.backend.cancel_command(self.job_id))
+        if self.scheduler is not None:
+            # nobody will wait on the cancelled id again
+            self.scheduler.forget(self.job_id)
+        # without a transient error the same input would fail the same way again
+        transient = self.log_monitor.transient
+        if (self.config['on_failure'] == 'resubmit' and transient is not None and
+                self.resubmits < self.config['max_resubmits']):
+            self.resubmits += 1
+            LOG.info('Resubmitting after %r (attempt %d of %d)', transient,
+                     self.resubmits, self.config['max_resubmits'])
+            self.connect_and_execute('rm -f {}/{}.log'.format(
+                self.working_directory, self.job_name))
+            self.job_status = None
+            self.submit_job()
+        else:
+            self.failed = True
 
 
     def check_status(self):
-        cmd = self.commands['check_status'].format(job_id=self.job_id)
-        ssh = self.connect_and_execute(cmd)
-        self.job_status = ssh.stdout.read().strip()
+        if self.scheduler is not None:
+            state = self.scheduler.wait(self.job_id, self.config['check_status_period'])
+            if state is not None:
+                self.job_status = state
+                if self.config['tail_log']:
+                    self.tail_log()
+                return
+            LOG.warning('Lost contact with scheduler daemon, polling directly')
+            self.scheduler = None
+
+        cmd = self.backend.status_command([self.job_id])
+        ssh = self.connection.run(cmd)
+        if ssh.returncode != 0:
+            # e.g. a dropped connection: no news about the job either way
+            LOG.warning("Status check exit status = %d: %s", ssh.returncode, ssh.stderr)
+        else:
+            state = self.backend.parse_status(ssh.stdout).get(
+                self.backend.job_key(self.job_id))
+            if state is None:
+                # an empty answer can also be a qstat timeout, so only a job
+                # missing from several polls in a row counts as gone
+                self.missing_polls += 1
+                if (self.backend.missing_state is not None and
+                        self.missing_polls >= self.config['scheduler_missing_polls']):
+                    state = self.backend.missing_state
+            else:
+                self.missing_polls = 0
+            self.job_status = state or self.job_status
         if not self.job_status:
             self.job_status = 'Unknown'
-        time.sleep(self.config['check_status_period'])
+        if self.config['tail_log']:
+            self.tail_log()
+        if self.running():
+            time.sleep(self.config['check_status_period'])
 
 
     def make_working_directory(self):
         cmd = self.config['remote_wd_setup'].format(remote_wd=self.working_directory)
         ssh = self.connect_and_execute(cmd)
+        # remote_wd may use $USER, ~ etc., which only the remote shell expands:
+        # rsync (3.2.4+) and scp pass their paths on without a shell, so every
+        # later transfer uses the absolute path the shell resolves it to
+        ssh = self.connect_and_execute('cd {} && pwd'.format(self.working_directory))
+        resolved = ssh.stdout.strip()
+        if resolved and resolved != self.working_directory:
+            LOG.debug('Remote working directory %s is %s', self.working_directory, resolved)
+            self.working_directory = resolved
+            self.setup_job_outputs()
 
     def check_connection(self):
-        LOG.debug("Testing connection to remote host '%s'", self.config['remote_host'])
+        LOG.debug("Testing connection to remote host '%s'", self.connection.host)
         ssh = self.connect_and_execute(self.config['remote_test_command'])
-        result = ssh.stdout.readlines()
-        if not result:
-            error_output = '\n'.join(ssh.stderr.readlines())
-            LOG.error('Error connecting to host %s', error_output)
+        result_string = ssh.stdout.strip()
+        if not result_string:
+            LOG.error('Error connecting to host %s', ssh.stderr)
             return False
-        result_string = '\n'.join(result).strip()
         LOG.debug("Command '%s' on %s yielded '%s'",
                   self.config['remote_test_command'],
-                  self.config['remote_host'],
+                  self.connection.host,
                   result_string)
         LOG.debug('Connection successful')
         return True
 
 
     def upload_files(self):
-        cmd = ["scp"] + self.job_inputs + \
-                [self.config['remote_host'] + ':' + self.working_directory]
-
-        scp = subprocess.Popen(cmd, shell=False,
-                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        scp.wait()
-        if not scp.returncode == 0:
-            LOG.error("Copying files '%s' to remote host exit status = %d",
-                      self.job_inputs,
-                      scp.returncode)
-            LOG.error("stderr:\n%s", ssh.stderr.read())
-            sys.exit(ssh.returncode)
+        names = [os.path.basename(f) for f in self.job_inputs]
+        changed = [l for l, r in self.changed_files(self.job_inputs, names)]
+        if len(changed) < len(self.job_inputs):
+            LOG.info('Skipping upload of unchanged files: %s',
+                     sorted(set(self.job_inputs) - set(changed)))
+        if changed:
+            self.copy_files(changed, self.connection.remote(self.working_directory),
+                            'to remote host')
+
+    def download_file(self, remote_name, local_name):
+        if not self.changed_files([local_name], [remote_name]):
+            LOG.info('%s is already up to date', local_name)
+            return
+        remote_path = '{}/{}'.format(self.working_directory, remote_name)
+        self.copy_files([self.connection.remote(remote_path)], local_name,
+                        'from remote host')
 
     def download_files(self):
         LOG.info('Downloading g09 log file')
-        cmd = ["scp", self.job_outputs[0], './remote.log']
-        scp = subprocess.Popen(cmd, shell=False,
-                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        scp.wait()
-        if not scp.returncode == 0:
-            LOG.error("Copying files '%s' from remote host exit status = %d",
-                      self.job_outputs,
-                      scp.returncode)
-            LOG.error("stderr:\n%s", scp.stderr.read())
-            sys.exit(scp.returncode)
-
-        with open('remote.log') as f:
-            contents = f.read()
-
-        LOG.info('Log contents:\n%s', contents)
+        self.download_file(self.job_name + '.log', 'remote.log')
+        log_file_contents('remote.log')
 
+        if self.failed:
+            return
         LOG.info('Downloading Test.FChk')
-        cmd = ["scp", self.job_outputs[1],  './']
-        scp = subprocess.Popen(cmd, shell=False,
-                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        scp.wait()
-        if not scp.returncode == 0:
-            LOG.error("Copying files '%s' from remote host exit status = %d",
-                      self.job_outputs,
-                      scp.returncode)
-            LOG.error("stderr:\n%s", scp.stderr.read())
-            sys.exit(scp.returncode)
+        self.download_file('Test.FChk', 'Test.FChk')
 
 
     def submit_job(self):
 
+        self.log_offset = 0
+        self.missing_polls = 0
+        self.log_monitor = GaussianLogMonitor()
+        if self.config['tail_log'] and os.path.exists('remote.log'):
+            os.remove('remote.log')
         self.make_working_directory()
         self.upload_files()
 
         LOG.info('Submitting remote job from %s', self.job_file)
-        submit_command = self.commands['submit'].format(job_name=self.job_name,
-                                                        job_file=self.job_file)
+        submit_command = self.backend.submit_command(self.job_name, self.job_file)
         LOG.info('Submit command = `%s`', submit_command)
         job_submit = self.config['remote_job_submit'].format(remote_wd=self.working_directory,
                                                              submit_command=submit_command)
         ssh = self.connect_and_execute(job_submit)
-        self.job_id = ssh.stdout.read().strip()
+        self.job_id = self.backend.parse_job_id(ssh.stdout)
         LOG.info('Submitted job ID: %s', self.job_id)
         if not self.job_id:
-            error_output = '\n'.join(ssh.stderr.readlines())
-            LOG.error('Error submitting job (job_id = %s): %s', self.job_id, error_output)
+            LOG.error('Error submitting job (job_id = %s): %s', self.job_id, ssh.stderr)
             sys.exit(1)
 
 
 
-def setup_logging(args):
-    handler = logging.FileHandler(args.filename[:-4]+'.log')
+class JobScheduler(object):
+
+    def __init__(self, config):
+        self.config = config
+        self.backend = BACKENDS[config['backend']]()
+        self.connection = make_connection(config)
+        self.jobs = {}
+        self.misses = {}
+        # when each job was first seen complete
+        self.completed = {}
+        self.condition = threading.Condition()
+        self.wakeup = threading.Event()
+        self.period = config['scheduler_min_period']
+        self.last_activity = time.time()
+
+    def register(self, job_id):
+        key = self.backend.job_key(job_id)
+        with self.condition:
+            self.last_activity = time.time()
+            if key not in self.jobs:
+                LOG.info('Registered job %s', job_id)
+                self.jobs[key] = None
+                self.period = self.config['scheduler_min_period']
+                self.wakeup.set()
+        return key
+
+    def wait(self, job_id, timeout):
+        key = self.register(job_id)
+        complete = self.backend.complete_states
+        deadline = time.time() + timeout
+        with self.condition:
+            while self.jobs.get(key) not in complete:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            state = self.jobs.get(key) or 'Unknown'
+            if state in complete:
+                self.forget(key)
+        return state
+
+    def forget(self, job_id):
+        key = self.backend.job_key(job_id)
+        with self.condition:
+            self.jobs.pop(key, None)
+            self.misses.pop(key, None)
+            self.completed.pop(key, None)
+            self.last_activity = time.time()
+
+    def forget_completed(self):
+        # jobs whose wrapper never came back for the result, e.g. because it
+        # was killed, would otherwise keep the daemon from idling out
+        now = time.time()
+        with self.condition:
+            stale = [k for k, t in self.completed.items()
+                     if now - t > self.config['scheduler_forget_after']]
+        for key in stale:
+            LOG.info('Forgetting job %s, its wrapper never collected it', key)
+            self.forget(key)
+
+    def status(self):
+        with self.condition:
+            return ['{} {}'.format(k, v or 'Unknown') for k, v in sorted(self.jobs.items())]
+
+    def poll(self):
+        complete = self.backend.complete_states
+        with self.condition:
+            pending = [k for k, v in self.jobs.items() if v not in complete]
+        if not pending:
+            return False
+        result = self.connection.run(self.backend.status_command(pending))
+        if result.returncode != 0:
+            LOG.error("Batched status check exit status = %d: %s",
+                      result.returncode, result.stderr)
+            return False
+        states = self.backend.parse_status(result.stdout)
+
+        changed = False
+        with self.condition:
+            for key in pending:
+                state = states.get(key)
+                if state is None:
+                    # no longer known to the queue, so it has finished
+                    self.misses[key] = self.misses.get(key, 0) + 1
+                    missing_polls = self.config['scheduler_missing_polls']
+                    if self.backend.missing_state is None or self.misses[key] < missing_polls:
+                        continue
+                    state = self.backend.missing_state
+                if key in self.jobs and self.jobs[key] != state:
+                    LOG.info('Job %s: %s -> %s', key, self.jobs[key], state)
+                    self.jobs[key] = state
+                    if state in complete:
+                        self.completed.setdefault(key, time.time())
+                    changed = True
+            if changed:
+                self.condition.notify_all()
+        return changed
+
+    def run(self):
+        while True:
+            if self.poll():
+                self.period = self.config['scheduler_min_period']
+            else:
+                self.period = min(self.period * self.config['scheduler_backoff'],
+                                  self.config['scheduler_max_period'])
+            self.wakeup.wait(self.period)
+            self.wakeup.clear()
+            self.forget_completed()
+            with self.condition:
+                idle = time.time() - self.last_activity
+                if not self.jobs and idle > self.config['scheduler_idle_timeout']:
+                    LOG.info('No jobs for %.0fs, exiting', idle)
+                    return
+
+
+class SchedulerRequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        tokens = self.rfile.readline().decode('utf-8').split()
+        if len(tokens) == 3 and tokens[0] == 'WAIT':
+            reply = [self.server.scheduler.wait(tokens[1], float(tokens[2]))]
+        elif len(tokens) == 2 and tokens[0] == 'FORGET':
+            self.server.scheduler.forget(tokens[1])
+            reply = ['OK']
+        elif tokens == ['STATUS']:
+            reply = self.server.scheduler.status()
+        else:
+            reply = ['ERROR unknown request']
+        self.wfile.write(''.join(line + '\n' for line in reply).encode('utf-8'))
+
+
+class SchedulerClient(object):
+
+    def __init__(self, path):
+        self.path = path
+
+    @classmethod
+    def connect(cls, path):
+        path = os.path.expanduser(path)
+        if not os.path.exists(path):
+            return None
+        LOG.info('Waiting on scheduler daemon at %s', path)
+        return cls(path)
+
+    def request(self, line, timeout):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(self.path)
+            sock.sendall((line + '\n').encode('utf-8'))
+            with sock.makefile('r', encoding='utf-8') as f:
+                return f.read()
+
+    def wait(self, job_id, timeout):
+        try:
+            state = self.request('WAIT {} {}'.format(job_id, timeout), timeout + 60)
+        except OSError:
+            return None
+        return state.strip() or None
+
+    def forget(self, job_id):
+        try:
+            self.request('FORGET {}'.format(job_id), 60)
+        except OSError:
+            pass
+
+
+def run_scheduler(config):
+    path = os.path.expanduser(config['scheduler_socket'])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.exists(path):
+        try:
+            SchedulerClient(path).request('STATUS', 5)
+            LOG.error('Scheduler already running at %s', path)
+            sys.exit(1)
+        except OSError:
+            os.unlink(path)
+
+    scheduler = JobScheduler(config)
+    scheduler.connection.start()
+    server = socketserver.ThreadingUnixStreamServer(path, SchedulerRequestHandler)
+    server.daemon_threads = True
+    server.scheduler = scheduler
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    LOG.info('Scheduler listening on %s', path)
+    try:
+        scheduler.run()
+    finally:
+        server.shutdown()
+        os.unlink(path)
+
+
+def setup_logging(filename):
+    handler = logging.FileHandler(filename)
     formatter = logging.Formatter('[%(name)-4s %(levelname)-3s %(asctime)s]: %(message)s')
     handler.setFormatter(formatter)
     LOG.addHandler(handler)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument("filename", type=str,
+    parser.add_argument("filename", type=str, nargs='?',
                         help='Input filename for gaussian job')
+    parser.add_argument("--scheduler", action='store_true',
+                        help='Run the local scheduler daemon that polls all '
+                             'registered jobs in one batched status call')
     args = parser.parse_args()
-    setup_logging(args)
+    if args.scheduler:
+        socket_path = os.path.expanduser(RemoteJob.config['scheduler_socket'])
+        os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+        setup_logging(os.path.join(os.path.dirname(socket_path), 'scheduler.log'))
+        run_scheduler(RemoteJob.config)
+        sys.exit(0)
+    if args.filename is None:
+        parser.error('an input filename is required')
+    setup_logging(args.filename[:-4]+'.log')
     job = RemoteJob(args.filename)
 
     while job.running():
         job.check_status()
         LOG.info('Status for job_id=%s: %s', job.job_id, job.job_status)
     job.download_files()
+    if job.failed:
+        LOG.error('Gaussian job %s failed: %s', args.filename, job.log_monitor.failure)
+        sys.exit(1)
     LOG.info('Gaussian job %s complete', args.filename)
     sys.exit(0)
@@ -1,57 +1,322 @@
 #!/usr/bin/env python
 
+import hashlib
+import json
 from pathlib import Path
 
+import numpy as np
+
 SHELL_KEYS = "spdfghSPDFGH"
+HEADER = "{\n   keys= { turbomole= }\n   data= {\n\n"
+FOOTER = "   }\n}\n"
+CACHE_FILENAME = ".gbs2tonto-cache"
+# bump when the output for the same input would change
+CACHE_VERSION = "1"
+SECTION_END = "****"
+NOT_PRIMITIVE = set("!*" + SHELL_KEYS)
+
+
+class Shell:
+    def __init__(self, kind, size, start, end):
+        # kind is None for primitives that follow a comment inside a shell
+        self.kind = kind
+        self.size = size
+        # rows of Basis.primitives belonging to this shell
+        self.start = start
+        self.end = end
+        self.primitives = None
+
+    @property
+    def exponents(self):
+        return self.primitives[:, 0]
+
+    @property
+    def coefficients(self):
+        return self.primitives[:, 1:]
+
+
+class Element:
+    def __init__(self, symbol):
+        self.symbol = symbol
+        # Shells, and comment lines in the order they appeared
+        self.items = []
+
+    @property
+    def shells(self):
+        return [item for item in self.items if isinstance(item, Shell)]
+
+
+class Basis:
+    def __init__(self, name, source):
+        self.name = name
+        self.source = source
+        # comment lines, SECTION_END markers and Elements in file order
+        self.blocks = []
+        # every primitive in the file, one row each, padded with nan
+        self.primitives = np.empty((0, 2))
+
+    @property
+    def elements(self):
+        return {b.symbol: b for b in self.blocks if isinstance(b, Element)}
+
+
+def _primitive_array(lines):
+    # one conversion for the whole file instead of a float() per number
+    text = "\n".join(lines).lower().replace("d", "e")
+    flat = np.array(text.split(), dtype=np.float64)
+    # tokens per line, found as the starts of runs of non-blank characters
+    chars = np.frombuffer(text.encode("latin-1"), dtype=np.uint8)
+    newline = chars == ord("\n")
+    blank = newline | (chars == ord(" ")) | (chars == ord("\t"))
+    starts = ~blank
+    starts[1:] &= blank[:-1]
+    row = np.cumsum(newline)
+    widths = np.bincount(row[starts], minlength=len(lines))
+    width = int(widths.max())
+    if (widths == width).all():
+        return flat.reshape(-1, width), widths.tolist()
+    values = np.full((len(lines), width), np.nan)
+    offsets = np.cumsum(widths) - widths
+    rows = np.repeat(np.arange(len(lines)), widths)
+    values[rows, np.arange(flat.size) - offsets[rows]] = flat
+    return values, widths.tolist()
+
+
+def parse_gbs(lines, name, source=None):
+    basis = Basis(name, source)
+    element, shell = None, None
+    primitives, shells = [], []
+
+    def close_shell():
+        if shell is not None:
+            kind, size, start = shell
+            element.items.append(Shell(kind, size, start, len(primitives)))
+            shells.append(element.items[-1])
+
+    for line in lines:
+        lstrip = line.strip()
+        if not lstrip:
+            continue
+        c = lstrip[0]
+        if element is not None and c not in NOT_PRIMITIVE:
+            # by far the most common line, so it is checked first
+            if shell is None:
+                # primitives continuing after a comment
+                shell = (None, None, len(primitives))
+            primitives.append(lstrip)
+        elif c == "!":
+            line = line.rstrip("\r\n")
+            if element is None:
+                basis.blocks.append(line)
+            else:
+                close_shell()
+                shell = None
+                element.items.append(line)
+        elif c == "*":
+            if element is not None:
+                close_shell()
+            element, shell = None, None
+            basis.blocks.append(SECTION_END)
+        elif element is None:
+            element = Element(lstrip.split()[0])
+            basis.blocks.append(element)
+        else:
+            close_shell()
+            tokens = lstrip.lower().split()
+            shell = (tokens[0], tokens[1], len(primitives))
+    if element is not None:
+        close_shell()
+
+    if primitives:
+        basis.primitives, widths = _primitive_array(primitives)
+        for s in shells:
+            width = min(widths[s.start:s.end], default=2)
+            s.primitives = basis.primitives[s.start:s.end, :width]
+    else:
+        for s in shells:
+            s.primitives = basis.primitives
+    return basis
+
+
+def read_gbs(path, name=None):
+    path = Path(path)
+    with path.open() as f:
+        return parse_gbs(f, name or path.stem, source=str(path))
+
+
+def formatted_primitives(basis, compact=False):
+    # every primitive line of the file formatted in one go
+    values = basis.primitives[:, :2]
+    if np.isnan(values).any():
+        values = np.nan_to_num(values)
+    fmt = "%r %r\n" if compact else "         %20.12f    %20.12f\n"
+    return (fmt * values.shape[0] % tuple(values.ravel().tolist())).splitlines(True)
+
+
+def _write_shell(f, shell, rows, compact):
+    if shell.kind is not None:
+        f.write(f"{shell.size} {shell.kind}\n" if compact
+                else f"      {shell.size}   {shell.kind}\n")
+    f.writelines(rows[shell.start:shell.end])
+
+
+def write_tonto(f, basis):
+    # same layout (and quirks) as the original line by line converter
+    rows = formatted_primitives(basis)
+    f.write(f"! converted from {basis.source} by gbs2tonto.py\n")
+    header_written = False
+    for block in basis.blocks:
+        if block is SECTION_END:
+            f.write("      }\n\n")
+        elif isinstance(block, str):
+            f.write(block + "\n")
+        else:
+            if not header_written:
+                f.write(HEADER)
+                header_written = True
+            f.write(f"      {block.symbol}:{basis.name} {{\n")
+            for item in block.items:
+                if isinstance(item, str):
+                    f.write(item + "\n")
+                else:
+                    _write_shell(f, item, rows, compact=False)
+    f.write(FOOTER)
+
+
+def write_library(f, bases, compact=False):
+    # any number of basis sets in one file, told apart by their labels
+    sources = " ".join(basis.source for basis in bases)
+    f.write(f"! converted from {sources} by gbs2tonto.py\n")
+    f.write("{\nkeys= { turbomole= }\ndata= {\n" if compact else HEADER)
+    for basis in bases:
+        rows = formatted_primitives(basis, compact)
+        for block in basis.blocks:
+            if isinstance(block, str) and block is not SECTION_END:
+                f.write(block + "\n")
+        for element in basis.elements.values():
+            f.write(f"{element.symbol}:{basis.name} {{\n" if compact
+                    else f"      {element.symbol}:{basis.name} {{\n")
+            for item in element.items:
+                if isinstance(item, str):
+                    f.write(item + "\n")
+                else:
+                    _write_shell(f, item, rows, compact)
+            f.write("}\n" if compact else "      }\n\n")
+    f.write("}\n}\n" if compact else FOOTER)
+
+
+def content_key(paths, *options):
+    h = hashlib.sha1(CACHE_VERSION.encode())
+    for option in options:
+        h.update(repr(option).encode())
+    for path in paths:
+        h.update(str(path).encode())
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+    return h.hexdigest()
+
+
+class ConversionCache:
+    # remembers which inputs each output was written from, next to the outputs
+    def __init__(self, directory):
+        self.filename = Path(directory) / CACHE_FILENAME
+        try:
+            self.entries = json.loads(self.filename.read_text())
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def up_to_date(self, output, key):
+        return Path(output).exists() and self.entries.get(Path(output).name) == key
+
+    def update(self, output, key):
+        self.entries[Path(output).name] = key
+
+    def save(self):
+        if self.entries:
+            tmp = self.filename.with_name(self.filename.name + ".tmp")
+            tmp.write_text(json.dumps(self.entries, indent=1, sort_keys=True))
+            tmp.replace(self.filename)
+
+
+def gbs_files(inputs):
+    for path in map(Path, inputs):
+        if path.is_dir():
+            yield from sorted(path.glob("*.gbs"))
+        else:
+            yield path
+
 
 def main():
     import argparse
+    import sys
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("input", help=".gbs formatted basis set file")
-    parser.add_argument("-o", "--output", help="destination tonto basis set file")
+    parser.add_argument("inputs", nargs="+",
+                        help=".gbs formatted basis set files, or directories of them")
+    parser.add_argument("-o", "--output",
+                        help="destination tonto basis set file, or directory "
+                             "when converting more than one basis set")
+    parser.add_argument("--library", metavar="FILE",
+                        help="write every basis set into this one tonto file")
+    parser.add_argument("--compact", action="store_true",
+                        help="minimal whitespace, shortest round-trip numbers")
+    parser.add_argument("--force", action="store_true",
+                        help="convert even if the output is up to date")
 
     args = parser.parse_args()
+    inputs = list(gbs_files(args.inputs))
+    if not inputs:
+        parser.error("no .gbs files found")
+
+    if args.library:
+        output = Path(args.library)
+        cache = ConversionCache(output.parent)
+        key = content_key(inputs, "library", args.compact)
+        if not args.force and cache.up_to_date(output, key):
+            print(f"{output} is up to date")
+            return
+        with output.open("w") as f:
+            write_library(f, [read_gbs(path) for path in inputs], compact=args.compact)
+        cache.update(output, key)
+        cache.save()
+        print(f"Wrote {len(inputs)} basis sets to {output}")
+        return
 
-    inp = Path(args.input).read_text()
-    lines = inp.splitlines()
-    basis_name = Path(args.input).stem
-    if not args.output:
-        args.output = Path(args.input).stem
-
-    with Path(args.output).open("w") as f:
-        f.write(f"! converted from {args.input} by gbs2tonto.py\n")
-        new_section = True
-        header_written = False
-        for line in lines:
-            lstrip = line.strip()
-            if not lstrip:
-                continue
-            elif lstrip.startswith("!"):
-                f.write(line)
-            elif lstrip.startswith("*"):
-                new_section = True
-                f.write("      }\n")
+    single = len(inputs) == 1 and not Path(args.inputs[0]).is_dir()
+    if single:
+        outputs = [Path(args.output or inputs[0].stem)]
+    else:
+        directory = Path(args.output or ".")
+        if directory.exists() and not directory.is_dir():
+            parser.error(f"{directory} must be a directory for more than one input")
+        directory.mkdir(parents=True, exist_ok=True)
+        outputs = [directory / path.stem for path in inputs]
+
+    # a single file is cheap to convert again, so only batch runs keep a
+    # cache file in the output directory
+    caches = {}
+    skipped = 0
+    for path, output in zip(inputs, outputs):
+        cache = None if single else caches.setdefault(
+            output.parent, ConversionCache(output.parent))
+        key = content_key([path], args.compact)
+        if cache is not None and not args.force and cache.up_to_date(output, key):
+            skipped += 1
+            continue
+        basis = read_gbs(path)
+        with output.open("w") as f:
+            if args.compact:
+                write_library(f, [basis], compact=True)
             else:
-                if not header_written:
-                    f.write("{\n   keys= { turbomole= }\n   data= {\n\n")
-                    header_written = True
-                if new_section:
-                    tokens = lstrip.split()
-                    f.write(f"      {tokens[0]}:{basis_name} {{")
-                    new_section = False
-                else:
-                    if lstrip[0] in SHELL_KEYS:
-                        tokens = lstrip.lower().split()
-                        f.write(f"      {tokens[1]}   {tokens[0]}")
-                    else:
-                        lstrip = lstrip.lower().replace("d", "e")
-                        tokens = lstrip.split()
-                        alpha, exp = float(tokens[0]), float(tokens[1])
-                        f.write(f"         {alpha:20.12f}    {exp:20.12f}")
-
-            f.write("\n")
-        f.write("   }\n}\n")
+                write_tonto(f, basis)
+        if cache is not None:
+            cache.update(output, key)
+    for cache in caches.values():
+        cache.save()
+    if not single or skipped:
+        print(f"Converted {len(inputs) - skipped} basis sets, "
+              f"{skipped} already up to date", file=sys.stderr)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,148 @@
+import os
+
+import numpy as np
+
+# On-disk layout of an sbf file: a file header, then one header per dataset,
+# then the raw (Fortran ordered) data for each dataset in the same order.
+SBF_FILE_TOKEN = b'SBF'
+SBF_NAMESIZE = 62
+SBF_MAX_DIM = 8
+
+FILE_HEADER = np.dtype([
+    ('token', 'S3'),
+    ('version', 'u1', 3),
+    ('n_datasets', '<u2'),
+])
+
+DATASET_HEADER = np.dtype([
+    ('flag', 'u1'),
+    ('name', 'S{}'.format(SBF_NAMESIZE)),
+    ('shape', '<u8', SBF_MAX_DIM),
+])
+
+SBF_DTYPE_MASK = 0b00001111
+SBF_DIMS_MASK = 0b01110000
+SBF_DIMS_SHIFT = 4
+SBF_COMPRESSED_MASK = 0b10000000
+
+SBF_DTYPES = {
+    0: np.dtype('S1'),
+    1: np.dtype('u1'),
+    2: np.dtype('<u2'),
+    3: np.dtype('<u4'),
+    4: np.dtype('<u8'),
+    5: np.dtype('i1'),
+    6: np.dtype('<i2'),
+    7: np.dtype('<i4'),
+    8: np.dtype('<i8'),
+    9: np.dtype('<f4'),
+    10: np.dtype('<f8'),
+    11: np.dtype('<c8'),
+    12: np.dtype('<c16'),
+}
+
+
+class UnsupportedLayout(ValueError):
+    pass
+
+
+class Dataset(object):
+
+    def __init__(self, filename, name, dtype, shape, offset):
+        self.filename = filename
+        self.name = name
+        self.dtype = dtype
+        self.shape = shape
+        self.offset = offset
+        self._data = None
+
+    @property
+    def nbytes(self):
+        return self.dtype.itemsize * int(np.prod(self.shape, dtype=np.int64))
+
+    @property
+    def data(self):
+        if self._data is None:
+            if self.nbytes == 0:
+                self._data = np.empty(self.shape, dtype=self.dtype, order='F')
+            else:
+                self._data = np.memmap(self.filename, dtype=self.dtype, mode='r',
+                                       offset=self.offset, shape=self.shape,
+                                       order='F')
+        return self._data
+
+    def __repr__(self):
+        return 'Dataset({!r}, dtype={}, shape={})'.format(
+            self.name, self.dtype, self.shape)
+
+
+class File(object):
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.datasets = {}
+        for dataset in read_headers(filename):
+            self.datasets[dataset.name] = dataset
+
+    def __getitem__(self, name):
+        return self.datasets[name]
+
+    def __contains__(self, name):
+        return name in self.datasets
+
+    def __iter__(self):
+        return iter(self.datasets)
+
+    def __len__(self):
+        return len(self.datasets)
+
+    def keys(self):
+        return self.datasets.keys()
+
+
+def read_headers(filename):
+    with open(filename, 'rb') as f:
+        contents = f.read(FILE_HEADER.itemsize)
+        if len(contents) != FILE_HEADER.itemsize:
+            raise UnsupportedLayout('{} is not an sbf file'.format(filename))
+        header = np.frombuffer(contents, dtype=FILE_HEADER)
+        if header['token'][0] != SBF_FILE_TOKEN:
+            raise UnsupportedLayout('{} is not an sbf file'.format(filename))
+        n_datasets = int(header['n_datasets'][0])
+        size = n_datasets * DATASET_HEADER.itemsize
+        contents = f.read(size)
+    if len(contents) != size:
+        raise UnsupportedLayout('{} has truncated dataset headers'.format(filename))
+    headers = np.frombuffer(contents, dtype=DATASET_HEADER)
+
+    offset = FILE_HEADER.itemsize + size
+    datasets = []
+    for h in headers:
+        flag = int(h['flag'])
+        if flag & SBF_COMPRESSED_MASK:
+            raise UnsupportedLayout('compressed datasets have no fixed offset')
+        dtype = SBF_DTYPES.get(flag & SBF_DTYPE_MASK)
+        if dtype is None:
+            raise UnsupportedLayout('unknown sbf data type {}'.format(flag))
+        ndims = (flag & SBF_DIMS_MASK) >> SBF_DIMS_SHIFT
+        shape = tuple(int(x) for x in h['shape'][:ndims])
+        try:
+            name = h['name'].rstrip(b'\x00').decode('ascii')
+        except UnicodeDecodeError:
+            raise UnsupportedLayout('{} has an unreadable dataset name'.format(filename))
+        dataset = Dataset(filename, name, dtype, shape, offset)
+        datasets.append(dataset)
+        offset += dataset.nbytes
+    # anything else means the layout isn't the one assumed here
+    if offset != os.path.getsize(filename):
+        raise UnsupportedLayout('{} datasets end at byte {}, not at the end of the '
+                                'file'.format(filename, offset))
+    return datasets
+
+
+def read_file(filename):
+    try:
+        return File(filename)
+    except UnsupportedLayout:
+        import sbf
+        return sbf.read_file(filename)
@@ -0,0 +1,376 @@
+import json
+import struct
+import numpy as np
+
+
+CHUNK_ROWS = 1 << 16
+
+
+def _chunks(n, size=CHUNK_ROWS):
+    for start in range(0, n, size):
+        yield start, min(start + size, n)
+
+
+def rgba8(colors):
+    rgba = np.empty((colors.shape[0], 4), dtype=np.uint8)
+    rgba[:, 3] = 255
+    for start, end in _chunks(colors.shape[0]):
+        c = np.nan_to_num(colors[start:end, :3], nan=0.0)
+        rgba[start:end, :3] = np.rint(np.clip(c, 0, 1) * 255)
+    return rgba
+
+
+def write_obj(filename, vertices, faces, normals, colors, index_base=0):
+    rgba = rgba8(colors)
+    offset = 1 - index_base
+    with open(filename, 'w') as f:
+        f.write('# exported by export_surface_mesh.py\n')
+        v_fmt = 'v %.8f %.8f %.8f %.4f %.4f %.4f\n'
+        for start, end in _chunks(vertices.shape[0]):
+            rows = np.hstack((vertices[start:end], rgba[start:end, :3] / 255.0))
+            f.write((v_fmt * (end - start)) % tuple(rows.ravel().tolist()))
+        vn_fmt = 'vn %.8f %.8f %.8f\n'
+        for start, end in _chunks(normals.shape[0]):
+            rows = normals[start:end]
+            f.write((vn_fmt * (end - start)) % tuple(rows.ravel().tolist()))
+        f_fmt = 'f %d//%d %d//%d %d//%d\n'
+        for start, end in _chunks(faces.shape[0]):
+            rows = np.repeat(faces[start:end] + offset, 2, axis=1)
+            f.write((f_fmt * (end - start)) % tuple(rows.ravel().tolist()))
+
+
+def write_ply(filename, vertices, faces, normals, colors, index_base=0):
+    rgba = rgba8(colors)
+    n_vertices, n_faces = vertices.shape[0], faces.shape[0]
+    header = (
+        'ply\n'
+        'format binary_little_endian 1.0\n'
+        'comment exported by export_surface_mesh.py\n'
+        'element vertex {}\n'
+        'property float x\nproperty float y\nproperty float z\n'
+        'property float nx\nproperty float ny\nproperty float nz\n'
+        'property uchar red\nproperty uchar green\n'
+        'property uchar blue\nproperty uchar alpha\n'
+        'element face {}\n'
+        'property list uchar int vertex_indices\n'
+        'end_header\n'
+    ).format(n_vertices, n_faces)
+    vertex_dtype = np.dtype([('position', '<f4', 3), ('normal', '<f4', 3),
+                             ('rgba', 'u1', 4)])
+    face_dtype = np.dtype([('count', 'u1'), ('index', '<i4', 3)])
+    with open(filename, 'wb') as f:
+        f.write(header.encode('ascii'))
+        for start, end in _chunks(n_vertices):
+            rows = np.empty(end - start, dtype=vertex_dtype)
+            rows['position'] = vertices[start:end]
+            rows['normal'] = normals[start:end]
+            rows['rgba'] = rgba[start:end]
+            f.write(rows.tobytes())
+        for start, end in _chunks(n_faces):
+            rows = np.empty(end - start, dtype=face_dtype)
+            rows['count'] = 3
+            rows['index'] = faces[start:end]
+            if index_base:
+                rows['index'] -= index_base
+            f.write(rows.tobytes())
+
+
+# glTF 2.0 constants
+GL_ARRAY_BUFFER = 34962
+GL_ELEMENT_ARRAY_BUFFER = 34963
+GL_BYTE = 5120
+GL_UNSIGNED_BYTE = 5121
+GL_SHORT = 5122
+GL_UNSIGNED_SHORT = 5123
+GL_UNSIGNED_INT = 5125
+GL_FLOAT = 5126
+GL_TRIANGLES = 4
+
+
+def _pad4(n):
+    return (4 - n % 4) % 4
+
+
+class GLBWriter(object):
+    # Collects buffer views as (array, dtype) pairs so that conversion to the
+    # on-disk type happens chunk by chunk while writing, not up front.
+
+    def __init__(self):
+        self.gltf = {
+            'asset': {'version': '2.0', 'generator': 'crystalexplorer-scripts'},
+            'scene': 0,
+            'scenes': [{'nodes': []}],
+            'nodes': [],
+            'meshes': [],
+            'accessors': [],
+            'bufferViews': [],
+            'buffers': [{'byteLength': 0}],
+        }
+        self.views = []
+        self.byte_length = 0
+
+    def add_view(self, array, dtype, target=None, transform=None, stride=None):
+        dtype = np.dtype(dtype)
+        row_size = dtype.itemsize * int(np.prod(array.shape[1:], dtype=int))
+        nbytes = array.shape[0] * row_size
+        view = {'buffer': 0, 'byteOffset': self.byte_length, 'byteLength': nbytes}
+        if target is not None:
+            view['target'] = target
+        if stride is not None:
+            view['byteStride'] = stride
+        self.gltf['bufferViews'].append(view)
+        self.views.append((array, dtype, transform))
+        self.byte_length += nbytes + _pad4(nbytes)
+        return len(self.views) - 1
+
+    def add_accessor(self, view, component_type, count, kind, **kwargs):
+        accessor = {'bufferView': view, 'componentType': component_type,
+                    'count': int(count), 'type': kind}
+        accessor.update(kwargs)
+        self.gltf['accessors'].append(accessor)
+        return len(self.gltf['accessors']) - 1
+
+    def add_mesh(self, primitives, name=None):
+        mesh = {'primitives': primitives}
+        if name is not None:
+            mesh['name'] = name
+        self.gltf['meshes'].append(mesh)
+        return len(self.gltf['meshes']) - 1
+
+    def add_node(self, mesh=None, root=True, **kwargs):
+        node = dict(kwargs)
+        if mesh is not None:
+            node['mesh'] = mesh
+        self.gltf['nodes'].append(node)
+        index = len(self.gltf['nodes']) - 1
+        if root:
+            self.gltf['scenes'][0]['nodes'].append(index)
+        return index
+
+    def add_extension(self, name, required=False):
+        keys = ('extensionsUsed', 'extensionsRequired') if required else ('extensionsUsed',)
+        for key in keys:
+            names = self.gltf.setdefault(key, [])
+            if name not in names:
+                names.append(name)
+
+    def add_triangles(self, vertices, faces, normals=None, colors=None,
+                      index_base=0, scalars=None):
+        vertices_view = self.add_view(vertices, '<f4', GL_ARRAY_BUFFER)
+        attributes = {'POSITION': self.add_accessor(
+            vertices_view, GL_FLOAT, vertices.shape[0], 'VEC3',
+            min=[float(x) for x in vertices.min(axis=0)],
+            max=[float(x) for x in vertices.max(axis=0)])}
+        if normals is not None:
+            view = self.add_view(normals, '<f4', GL_ARRAY_BUFFER)
+            attributes['NORMAL'] = self.add_accessor(
+                view, GL_FLOAT, normals.shape[0], 'VEC3')
+        if colors is not None:
+            view = self.add_view(rgba8(colors), 'u1', GL_ARRAY_BUFFER)
+            attributes['COLOR_0'] = self.add_accessor(
+                view, GL_UNSIGNED_BYTE, colors.shape[0], 'VEC4', normalized=True)
+        # application specific attributes, whose names must start with '_'
+        for name, values in (scalars or {}).items():
+            view = self.add_view(values, '<f4', GL_ARRAY_BUFFER)
+            attributes[name] = self.add_accessor(
+                view, GL_FLOAT, values.shape[0], 'SCALAR',
+                min=[float(values.min())], max=[float(values.max())])
+        transform = (lambda x: x - index_base) if index_base else None
+        faces_view = self.add_view(faces, '<u4', GL_ELEMENT_ARRAY_BUFFER,
+                                   transform=transform)
+        indices = self.add_accessor(faces_view, GL_UNSIGNED_INT,
+                                    faces.size, 'SCALAR')
+        return {'attributes': attributes, 'indices': indices,
+                'mode': GL_TRIANGLES}
+
+    def write(self, filename):
+        self.gltf['buffers'][0]['byteLength'] = self.byte_length
+        if not self.gltf['nodes']:
+            del self.gltf['nodes']
+            del self.gltf['scenes']
+            del self.gltf['scene']
+        content = json.dumps(self.gltf, separators=(',', ':')).encode('utf-8')
+        content += b' ' * _pad4(len(content))
+        total = 12 + 8 + len(content) + 8 + self.byte_length
+        with open(filename, 'wb') as f:
+            f.write(struct.pack('<4sII', b'glTF', 2, total))
+            f.write(struct.pack('<I4s', len(content), b'JSON'))
+            f.write(content)
+            f.write(struct.pack('<I4s', self.byte_length, b'BIN\x00'))
+            for array, dtype, transform in self.views:
+                nbytes = 0
+                for start, end in _chunks(array.shape[0]):
+                    chunk = array[start:end]
+                    if transform is not None:
+                        chunk = transform(chunk)
+                    data = np.ascontiguousarray(chunk, dtype=dtype).tobytes()
+                    nbytes += len(data)
+                    f.write(data)
+                f.write(b'\x00' * _pad4(nbytes))
+
+
+def write_glb(filename, vertices, faces, normals, colors, index_base=0,
+              scalars=None):
+    glb = GLBWriter()
+    primitive = glb.add_triangles(vertices, faces, normals, colors,
+                                  index_base=index_base, scalars=scalars)
+    glb.add_node(glb.add_mesh([primitive]))
+    glb.write(filename)
+
+
+def lod_coverage(counts):
+    # MSFT_screencoverage: the smallest fraction of the screen height each
+    # level is shown at, so each level is used until its triangles would get
+    # about as small on screen as the next level's; the last level is never
+    # culled
+    full = float(counts[0])
+    return [(n / full) ** 0.5 for n in counts[1:]] + [0.0]
+
+
+def write_lod_glb(filename, levels, name=None):
+    # levels: (vertices, faces, normals, colors, scalars) from the most to the
+    # least detailed, with zero based faces. The first level is the scene
+    # node, the others are listed in its MSFT_lod extension.
+    glb = GLBWriter()
+    glb.add_extension('MSFT_lod')
+    nodes = []
+    for i, (vertices, faces, normals, colors, scalars) in enumerate(levels):
+        primitive = glb.add_triangles(vertices, faces, normals, colors,
+                                      scalars=scalars)
+        mesh_name = None if name is None else '{}_lod{}'.format(name, i)
+        nodes.append(glb.add_node(glb.add_mesh([primitive], name=mesh_name),
+                                  root=False))
+    root = glb.gltf['nodes'][nodes[0]]
+    if len(levels) > 1:
+        root['extensions'] = {'MSFT_lod': {'ids': nodes[1:]}}
+        root['extras'] = {'MSFT_screencoverage': lod_coverage(
+            [level[0].shape[0] for level in levels])}
+    glb.gltf['scenes'][0]['nodes'].append(nodes[0])
+    glb.write(filename)
+
+
+class Rows(object):
+    # several arrays one after the other, each made a chunk at a time by
+    # function(start, end) when the writer reaches it
+    def __init__(self, parts, row_shape=()):
+        self.counts = [count for count, _ in parts]
+        self.functions = [function for _, function in parts]
+        self.offsets = np.concatenate([[0], np.cumsum(self.counts, dtype=np.int64)])
+        self.shape = (int(self.offsets[-1]),) + tuple(row_shape)
+
+    def __getitem__(self, index):
+        start, stop, _ = index.indices(self.shape[0])
+        pieces = []
+        first = np.searchsorted(self.offsets, start, side='right') - 1
+        for i in range(first, len(self.counts)):
+            lo, hi = self.offsets[i], self.offsets[i + 1]
+            if lo >= stop:
+                break
+            if hi > start:
+                pieces.append(self.functions[i](max(start, lo) - lo, min(stop, hi) - lo))
+        return np.concatenate(pieces)
+
+
+# interleaved vertex layout of merged scenes (KHR_mesh_quantization): int16
+# positions relative to the scene node transform, int8 unit normals, RGBA and
+# the surface property, 20 bytes per vertex with every attribute 4 byte aligned
+QUANTIZED_VERTEX = np.dtype({
+    'names': ['position', 'normal', 'rgba', 'property'],
+    'formats': [('<i2', 3), ('i1', 3), ('u1', 4), '<f4'],
+    'offsets': [0, 8, 12, 16],
+    'itemsize': 20,
+})
+POSITION_LEVELS = 32767
+NORMAL_LEVELS = 127
+
+
+def quantized_vertices(read, center, step):
+    def records(start, end):
+        vertices, _, normals, colors, prop = read()
+        rows = np.zeros(end - start, dtype=QUANTIZED_VERTEX)
+        rows['position'] = np.rint((vertices[start:end] - center) / step)
+        n = np.asarray(normals[start:end], dtype=np.float64)
+        length = np.linalg.norm(n, axis=1, keepdims=True)
+        rows['normal'] = np.rint(NORMAL_LEVELS * n / np.where(length > 0, length, 1))
+        rows['rgba'] = rgba8(colors[start:end])
+        rows['property'] = prop[start:end]
+        return rows
+    return records
+
+
+def write_merged_glb(filename, surfaces, index_base=0, property_name='_PROPERTY'):
+    # surfaces: (name, read) for each surface, where read() returns its
+    # (vertices, faces, normals, colors, prop); colors only needs to support
+    # slicing rows. read is called again for each chunk and its arrays
+    # dropped after, so with memory mapped files only one is open at a time.
+    # All surfaces share one interleaved vertex view and one index view, and
+    # each surface is a node whose primitive is its range of both.
+    bounds = []
+    for name, read in surfaces:
+        vertices, faces, _, _, prop = read()
+        bounds.append((vertices.shape[0], faces.shape[0],
+                       vertices.min(axis=0).astype(np.float64),
+                       vertices.max(axis=0).astype(np.float64),
+                       float(prop.min()), float(prop.max())))
+        del vertices, faces, prop
+    lo = np.min([b[2] for b in bounds], axis=0)
+    hi = np.max([b[3] for b in bounds], axis=0)
+    center = 0.5 * (lo + hi)
+    # one step for all axes, so the node scale is uniform and leaves normals alone
+    step = max(float((hi - lo).max()) / (2 * POSITION_LEVELS), 1e-12)
+    index_dtype = np.dtype('<u2' if max(b[0] for b in bounds) <= 0xffff else '<u4')
+
+    glb = GLBWriter()
+    glb.add_extension('KHR_mesh_quantization', required=True)
+    vertex_parts, face_parts = [], []
+    for (name, read), (n_vertices, n_faces, _, _, _, _) in zip(surfaces, bounds):
+        vertex_parts.append((n_vertices, quantized_vertices(read, center, step)))
+        face_parts.append((n_faces, lambda start, end, read=read:
+                           read()[1][start:end] - index_base))
+    vertex_view = glb.add_view(Rows(vertex_parts), QUANTIZED_VERTEX, GL_ARRAY_BUFFER,
+                               stride=QUANTIZED_VERTEX.itemsize)
+    index_view = glb.add_view(Rows(face_parts, (3,)), index_dtype,
+                              GL_ELEMENT_ARRAY_BUFFER)
+
+    children = []
+    vertex_start, index_start = 0, 0
+    for (name, _), (n_vertices, n_faces, v_lo, v_hi, p_lo, p_hi) in zip(surfaces, bounds):
+        n_indices = 3 * n_faces
+        offset = vertex_start * QUANTIZED_VERTEX.itemsize
+
+        def attribute(field, component_type, kind, **kwargs):
+            return glb.add_accessor(
+                vertex_view, component_type, n_vertices, kind,
+                byteOffset=offset + QUANTIZED_VERTEX.fields[field][1], **kwargs)
+
+        lo_q = np.rint((v_lo - center) / step)
+        hi_q = np.rint((v_hi - center) / step)
+        attributes = {
+            'POSITION': attribute('position', GL_SHORT, 'VEC3',
+                                  min=[int(x) for x in lo_q], max=[int(x) for x in hi_q]),
+            'NORMAL': attribute('normal', GL_BYTE, 'VEC3', normalized=True),
+            'COLOR_0': attribute('rgba', GL_UNSIGNED_BYTE, 'VEC4', normalized=True),
+            property_name: attribute('property', GL_FLOAT, 'SCALAR',
+                                     min=[p_lo], max=[p_hi]),
+        }
+        indices = glb.add_accessor(
+            index_view,
+            GL_UNSIGNED_SHORT if index_dtype.itemsize == 2 else GL_UNSIGNED_INT,
+            n_indices, 'SCALAR', byteOffset=index_start * index_dtype.itemsize)
+        mesh = glb.add_mesh([{'attributes': attributes, 'indices': indices,
+                              'mode': GL_TRIANGLES}], name=name)
+        children.append(glb.add_node(mesh, root=False, name=name, extras={
+            'vertex_range': [vertex_start, vertex_start + n_vertices],
+            'index_range': [index_start, index_start + n_indices]}))
+        vertex_start += n_vertices
+        index_start += n_indices
+    glb.add_node(name='surfaces', children=children,
+                 translation=[float(x) for x in center], scale=[step] * 3)
+    glb.write(filename)
+
+
+WRITERS = {
+    'obj': write_obj,
+    'ply': write_ply,
+    'glb': write_glb,
+}
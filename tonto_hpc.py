@@ -2,13 +2,138 @@
 # -*- coding: utf-8 -*-
 import sys
 import os
+
+# CrystalExplorer runs this in place of tonto for every calculation, so
+# anything that isn't an interaction energy is handed straight to tonto
+# before the rest of the script is even imported.
+INTERACTION_ENERGY_KEYWORD = b'put_group_12_energies'
+# how much of the input to search for the keyword
+INPUT_SCAN_LIMIT = 1 << 20
+TONTO_LOCATION_CACHE = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser(os.path.join('~', '.cache')),
+    'tonto_hpc', 'tonto')
+
+def is_executable(path):
+    return os.path.isfile(path) and os.access(path, os.X_OK)
+
+def which(prog):
+    fpath, fname = os.path.split(prog)
+    if fpath and is_executable(fname):
+        return prog
+    else:
+        for path in os.environ['PATH'].split(os.pathsep):
+            exe_file = os.path.join(path, prog)
+            if is_executable(exe_file):
+                return exe_file
+    return None
+
+def cached_which(prog, cache_filename=TONTO_LOCATION_CACHE):
+    # the PATH search is only repeated when PATH changes or the
+    # executable disappears
+    search_path = os.environ.get('PATH', '')
+    try:
+        with open(cache_filename) as f:
+            cached_path, exe = f.read().split('\n')[:2]
+        if cached_path == search_path and is_executable(exe):
+            return exe
+    except (OSError, ValueError):
+        pass
+    exe = which(prog)
+    if exe is not None:
+        try:
+            os.makedirs(os.path.dirname(cache_filename), exist_ok=True)
+            tmp = '{}.{}.tmp'.format(cache_filename, os.getpid())
+            with open(tmp, 'w') as f:
+                f.write('{}\n{}\n'.format(search_path, os.path.abspath(exe)))
+            os.replace(tmp, cache_filename)
+        except OSError:
+            pass
+    return exe
+
+def input_contains(filename, keyword=INTERACTION_ENERGY_KEYWORD,
+                   limit=INPUT_SCAN_LIMIT, blocksize=1 << 16):
+    # inputs longer than limit without the keyword are simply run by tonto
+    previous = b''
+    try:
+        with open(filename, 'rb') as f:
+            for _ in range(0, limit, blocksize):
+                block = f.read(blocksize)
+                if not block:
+                    break
+                if keyword in previous[-len(keyword):] + block:
+                    return True
+                previous = block
+    except OSError:
+        pass
+    return False
+
+def exec_tonto():
+    tonto_exe = cached_which('tonto')
+    if tonto_exe is None:
+        with open('stdout', 'w') as f:
+            f.write('Could not find tonto executable')
+        sys.exit(1)
+    sys.stdout.flush()
+    os.execv(tonto_exe, [tonto_exe])
+
+if __name__ == '__main__' and len(sys.argv) == 1 and not input_contains('stdin'):
+    exec_tonto()
+
 import subprocess
 import hashlib
 import re
 import shutil
+import time
 
 WFN_REGEX = re.compile(r'\"(.*)\.(FChk|sbf|fchk)\"')
 STORAGE_DIRECTORY = 'tonto_hpc_files'
+BLOB_DIRECTORY = os.path.join(STORAGE_DIRECTORY, 'blobs')
+DIGEST_CACHE_DIRECTORY = os.path.join(BLOB_DIRECTORY, 'digests')
+MANIFEST_FILENAME = 'wavefunctions'
+CANONICAL_DIRECTORY = os.path.join(STORAGE_DIRECTORY, 'canonical')
+GEOMETRY_FILENAME = 'geometry'
+INDEX_FILENAME = 'index.sqlite'
+JOB_STATES = ('pending', 'submitted', 'done', 'failed')
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    directory TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    elapsed REAL,
+    bundle TEXT
+);
+CREATE TABLE IF NOT EXISTS inputs (
+    key TEXT PRIMARY KEY,
+    directory TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS energies (
+    directory TEXT PRIMARY KEY,
+    coul REAL,
+    pol REAL,
+    disp REAL,
+    rep REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_by_state ON jobs (state);
+CREATE INDEX IF NOT EXISTS inputs_by_directory ON inputs (directory);
+"""
+ENERGY_TERMS = {
+    'Delta E_coul': 'coul',
+    'Polarization energy': 'pol',
+    'Grimme06 dispersion energy': 'disp',
+    'Delta E_exch-rep': 'rep',
+}
+ENERGY_COLUMNS = ('coul', 'pol', 'disp', 'rep')
+ENERGY_REGEX = re.compile(
+    r'^\s*(' + '|'.join(re.escape(t) for t in ENERGY_TERMS) + r') \(kJ/mol\) \.+\s+(\S+)',
+    re.MULTILINE)
+# largest allowed difference in any interatomic distance (angstrom) for two
+# inputs to share a cached result
+GEOMETRY_TOLERANCE = 1e-3
+TOKEN_REGEX = re.compile(r'"[^"]*"|[^\s"]+')
+FLOAT = r'([-+]?(?:\d+\.?\d*|\.\d+)(?:[eEdD][-+]?\d+)?)'
+ATOM_LINE_REGEX = re.compile(
+    r'^\s*([A-Za-z]+)[^\s=]*\s+' + r'\s+'.join([FLOAT] * 3) + r'\s*$')
 PLACEHOLDER_STDOUT = """_______________________________________________________________
 
  T   O   N   T   O
@@ -111,27 +236,85 @@ Additional files will be written to:
 ******************************************************************************
 """
 
-def is_executable(path):
-    return os.path.isfile(path) and os.access(path, os.X_OK)
-
-def which(prog):
-    fpath, fname = os.path.split(prog)
-    if fpath and is_executable(fname):
-        return prog
-    else:
-        for path in os.environ['PATH'].split(os.pathsep):
-            exe_file = os.path.join(path, prog)
-            if is_executable(exe_file):
-                return exe_file
-    return None
-
 def hash_file(contents):
     return hashlib.sha1(contents.encode('latin-1')).hexdigest()
 
+def file_digest(filename, blocksize=1 << 20):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def atomic_write(filename, contents, mode='w'):
+    tmp = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(tmp, mode) as f:
+        f.write(contents)
+    os.replace(tmp, filename)
+
+def cached_digest(filename):
+    # wavefunctions are hashed once per (path, size, mtime) rather than on
+    # every one of the hundreds of tonto calls that reference them
+    st = os.stat(filename)
+    key = hashlib.sha1(os.path.abspath(filename).encode('utf-8')).hexdigest()
+    cache_filename = os.path.join(DIGEST_CACHE_DIRECTORY, key)
+    stamp = '{} {}'.format(st.st_size, st.st_mtime_ns)
+    cached = file_contents(cache_filename).split()
+    if len(cached) == 3 and ' '.join(cached[:2]) == stamp:
+        return cached[2]
+    digest = file_digest(filename)
+    os.makedirs(DIGEST_CACHE_DIRECTORY, exist_ok=True)
+    atomic_write(cache_filename, '{} {}\n'.format(stamp, digest))
+    return digest
+
+def store_blob(filename):
+    blob = cached_digest(filename) + os.path.splitext(filename)[1]
+    blob_filename = os.path.join(BLOB_DIRECTORY, blob)
+    if not os.path.exists(blob_filename):
+        os.makedirs(BLOB_DIRECTORY, exist_ok=True)
+        tmp = '{}.{}.tmp'.format(blob_filename, os.getpid())
+        shutil.copyfile(filename, tmp)
+        os.replace(tmp, blob_filename)
+    return blob
+
+def read_manifest(directory):
+    entries = []
+    for line in file_contents(os.path.join(directory, MANIFEST_FILENAME)).splitlines():
+        tokens = line.split(None, 1)
+        if len(tokens) == 2:
+            entries.append((tokens[0], tokens[1]))
+    return entries
+
+def link_wavefunctions(directory, blob_directory=BLOB_DIRECTORY, target=None,
+                       copy_fallback=True):
+    # hardlink each blob in the manifest into target (default: directory)
+    # under the name the input refers to, copying if links are unsupported
+    target = directory if target is None else target
+    for blob, name in read_manifest(directory):
+        destination = os.path.join(target, name)
+        if os.path.exists(destination):
+            continue
+        source = os.path.join(blob_directory, blob)
+        try:
+            os.link(source, destination)
+        except OSError:
+            if not copy_fallback:
+                raise
+            shutil.copyfile(source, destination)
+
 def copy_wavefunctions(input_contents, output_directory):
     wavefunctions = WFN_REGEX.findall(input_contents)
+    manifest = []
     for wfn in wavefunctions:
-        shutil.copy('.'.join(wfn), output_directory)
+        filename = '.'.join(wfn)
+        blob = store_blob(filename)
+        manifest.append('{} {}\n'.format(blob, os.path.basename(filename)))
+    atomic_write(os.path.join(output_directory, MANIFEST_FILENAME), ''.join(manifest))
+    try:
+        link_wavefunctions(output_directory, copy_fallback=False)
+    except OSError:
+        # the manifest is enough to restore the files with link_wavefunctions
+        pass
 
 def file_contents(filename):
     if not os.path.exists(filename):
@@ -139,17 +322,182 @@ def file_contents(filename):
     with open(filename) as f:
         return f.read()
 
-def check_cache(input_contents):
-    if not os.path.exists(STORAGE_DIRECTORY):
-        os.mkdir(STORAGE_DIRECTORY)
+def canonical_input(input_contents):
+    # Whitespace, comments and the job name are dropped, wavefunction paths
+    # become content hashes and atom lines are pulled out as the geometry.
+    # Returns None if the input can't be canonicalised safely.
+    tokens, elements, positions = [], [], []
+    depth, skip = 0, False
+    for line in input_contents.splitlines():
+        line = line.split('!', 1)[0]
+        m = ATOM_LINE_REGEX.match(line)
+        if m:
+            elements.append(m.group(1).upper())
+            positions.append(tuple(float(x.replace('d', 'e').replace('D', 'e'))
+                                   for x in m.groups()[1:]))
+            tokens.append('@atom')
+            continue
+        for token in TOKEN_REGEX.findall(line):
+            if skip:
+                skip = False
+                continue
+            if token == 'name=' and depth == 1:
+                skip = True
+                continue
+            depth += (token == '{') - (token == '}')
+            wfn = WFN_REGEX.match(token)
+            if wfn:
+                filename = '.'.join(wfn.groups())
+                if not os.path.exists(filename):
+                    return None
+                token = '"{}.{}"'.format(cached_digest(filename), wfn.group(2))
+            tokens.append(token)
+    if not positions:
+        return None
+    return ' '.join(tokens), elements, positions
 
-    h = hash_file(input_contents)
+def read_geometry(directory):
+    elements, positions = [], []
+    for line in file_contents(os.path.join(directory, GEOMETRY_FILENAME)).splitlines():
+        tokens = line.split()
+        if len(tokens) == 4:
+            elements.append(tokens[0])
+            positions.append(tuple(float(x) for x in tokens[1:]))
+    return elements, positions
 
-    output_directory = os.path.join(
-        STORAGE_DIRECTORY, h
-    )
-    if not os.path.exists(output_directory):
-        os.mkdir(output_directory)
+def write_geometry(directory, elements, positions):
+    atomic_write(os.path.join(directory, GEOMETRY_FILENAME), ''.join(
+        '{} {!r} {!r} {!r}\n'.format(e, *p) for e, p in zip(elements, positions)))
+
+def same_geometry(a, b, tolerance=GEOMETRY_TOLERANCE):
+    # equal up to a rigid transform: every interatomic distance matches,
+    # with atoms taken in input order
+    import numpy as np
+    (elements_a, positions_a), (elements_b, positions_b) = a, b
+    if elements_a != elements_b:
+        return False
+    distances = []
+    for positions in (positions_a, positions_b):
+        p = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+        distances.append(np.linalg.norm(p[:, None] - p[None, :], axis=-1))
+    return bool(np.allclose(distances[0], distances[1], rtol=0, atol=tolerance))
+
+def cache_directory(input_contents):
+    # exact matches (and everything cached before canonical keys) live in
+    # the raw hash directory; otherwise look for an equivalent input
+    output_directory = os.path.join(STORAGE_DIRECTORY, hash_file(input_contents))
+    if os.path.exists(os.path.join(output_directory, 'stdin')):
+        return output_directory
+    canonical = canonical_input(input_contents)
+    if canonical is None:
+        return output_directory
+    text, elements, positions = canonical
+    index = os.path.join(CANONICAL_DIRECTORY, hash_file(text))
+    for name in file_contents(index).split():
+        candidate = os.path.join(STORAGE_DIRECTORY, name)
+        if same_geometry(read_geometry(candidate), (elements, positions)):
+            return candidate
+    os.makedirs(output_directory, exist_ok=True)
+    write_geometry(output_directory, elements, positions)
+    os.makedirs(CANONICAL_DIRECTORY, exist_ok=True)
+    with open(index, 'a') as f:
+        f.write(os.path.basename(output_directory) + '\n')
+    return output_directory
+
+def open_index(storage=STORAGE_DIRECTORY):
+    import sqlite3
+    filename = os.path.join(storage, INDEX_FILENAME)
+    try:
+        db = sqlite3.connect(filename, timeout=60)
+    except sqlite3.OperationalError:
+        os.makedirs(storage, exist_ok=True)
+        db = sqlite3.connect(filename, timeout=60)
+    db.executescript(INDEX_SCHEMA)
+    return db
+
+STATE_UPSERT = (
+    'INSERT INTO jobs (directory, state, created, updated, elapsed, bundle) '
+    'VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (directory) DO UPDATE SET '
+    'state = excluded.state, updated = excluded.updated, '
+    'elapsed = coalesce(excluded.elapsed, elapsed), '
+    'bundle = coalesce(excluded.bundle, bundle)')
+
+def set_state(db, directory, state, elapsed=None, bundle=None):
+    # directory is the name of the job directory inside the storage directory
+    now = time.time()
+    with db:
+        db.execute(STATE_UPSERT, (directory, state, now, now, elapsed, bundle))
+
+def parse_energies(contents):
+    energies = {}
+    for term, value in ENERGY_REGEX.findall(contents):
+        try:
+            energies[ENERGY_TERMS[term]] = float(value)
+        except ValueError:
+            pass
+    return energies
+
+def record_result(db, directory, contents, elapsed=None):
+    # a finished job: energies are parsed once here instead of on every export
+    energies = parse_energies(contents)
+    now = time.time()
+    with db:
+        db.execute(STATE_UPSERT, (directory, 'done', now, now, elapsed, None))
+        db.execute('INSERT OR REPLACE INTO energies (directory, {}) VALUES (?, ?, ?, ?, ?)'.format(
+            ', '.join(ENERGY_COLUMNS)),
+            (directory,) + tuple(energies.get(c) for c in ENERGY_COLUMNS))
+
+def register_input(db, key, directory, state):
+    now = time.time()
+    with db:
+        db.execute('INSERT OR IGNORE INTO jobs (directory, state, created, updated) '
+                   'VALUES (?, ?, ?, ?)', (directory, state, now, now))
+        db.execute('INSERT OR REPLACE INTO inputs (key, directory) VALUES (?, ?)',
+                   (key, directory))
+
+def directory_state(directory, previous=None):
+    if os.path.exists(os.path.join(directory, 'stdout')):
+        return 'done'
+    if os.path.exists(os.path.join(directory, 'failed')):
+        return 'failed'
+    return previous if previous == 'submitted' else 'pending'
+
+def scan_index(db, storage=STORAGE_DIRECTORY):
+    # bring the index in line with the directories on disk
+    known = dict(db.execute('SELECT directory, state FROM jobs'))
+    present = set()
+    for directory in job_directories(storage):
+        name = os.path.basename(directory)
+        present.add(name)
+        state = directory_state(directory, known.get(name))
+        if known.get(name) != state:
+            if state == 'done':
+                record_result(db, name, file_contents(os.path.join(directory, 'stdout')))
+            else:
+                set_state(db, name, state)
+        if name not in known:
+            # job directories are named after the hash of their first input
+            register_input(db, name, name, state)
+    missing = [(name,) for name in known if name not in present]
+    with db:
+        db.executemany('DELETE FROM jobs WHERE directory = ?', missing)
+        db.executemany('DELETE FROM inputs WHERE directory = ?', missing)
+        db.executemany('DELETE FROM energies WHERE directory = ?', missing)
+    return len(missing)
+
+def check_cache(input_contents):
+    h = hash_file(input_contents)
+    db = open_index()
+    row = db.execute('SELECT directory, state FROM inputs JOIN jobs USING (directory) '
+                     'WHERE key = ?', (h,)).fetchone()
+    if row is None:
+        # not indexed yet: find or create the directory on disk
+        output_directory = cache_directory(input_contents)
+        name, state = os.path.basename(output_directory), directory_state(output_directory)
+        register_input(db, h, name, state)
+    else:
+        name, state = row
+        output_directory = os.path.join(STORAGE_DIRECTORY, name)
 
     storage_filename = os.path.join(
         output_directory,
@@ -159,35 +507,515 @@ def check_cache(input_contents):
         output_directory,
         'stdout'
     )
-    if os.path.exists(output_filename):
-        with open(output_filename) as of:
-            with open('stdout', 'w') as f:
-                f.write(of.read())
-    else:
-        with open(storage_filename, 'w') as f:
+    if state != 'done' and os.path.exists(output_filename):
+        # results copied into the cache by hand
+        record_result(db, name, file_contents(output_filename))
+        state = 'done'
+    if state == 'done':
+        try:
+            with open(output_filename) as of:
+                with open('stdout', 'w') as f:
+                    f.write(of.read())
+            return
+        except FileNotFoundError:
+            set_state(db, name, 'pending')
+    # only pending jobs get here, so hits never touch the directory. An
+    # equivalent input may already be waiting there: it keeps its stdin and
+    # wavefunctions and this one only points at the result
+    os.makedirs(output_directory, exist_ok=True)
+    try:
+        with open(storage_filename, 'x') as f:
             f.write(input_contents)
+    except FileExistsError:
+        pass
+    else:
         copy_wavefunctions(input_contents, output_directory)
-        with open('stdout', 'w') as f:
-            f.write(PLACEHOLDER_STDOUT.format(
-                directory=os.path.abspath(output_directory))
-            )
+    with open('stdout', 'w') as f:
+        f.write(PLACEHOLDER_STDOUT.format(
+            directory=os.path.abspath(output_directory))
+        )
 
 def is_interaction_energy_input(contents):
-    return 'put_group_12_energies' in contents
+    return INTERACTION_ENERGY_KEYWORD.decode('ascii') in contents
 
 def run_tonto(input_contents):
-    tonto_exe = which('tonto')
-    if tonto_exe is None:
-        with open('stdout', 'w') as f:
-            f.write('Could not find tonto executable')
-        sys.exit(1)
     if is_interaction_energy_input(input_contents):
         check_cache(input_contents)
     else:
-        sys.exit(subprocess.call([tonto_exe]))
+        exec_tonto()
+
+def job_directories(storage=STORAGE_DIRECTORY):
+    for name in sorted(os.listdir(storage)):
+        directory = os.path.join(storage, name)
+        if os.path.exists(os.path.join(directory, 'stdin')):
+            yield directory
+
+def is_pending(directory):
+    return not os.path.exists(os.path.join(directory, 'stdout'))
+
+def job_cost(directory, storage=STORAGE_DIRECTORY):
+    # interaction energy cost grows with the size of the wavefunctions involved
+    blobs = os.path.join(storage, 'blobs')
+    manifest = read_manifest(directory)
+    if manifest:
+        paths = [os.path.join(blobs, blob) for blob, _ in manifest]
+    else:
+        paths = [os.path.join(directory, f) for f in os.listdir(directory)
+                 if WFN_REGEX.match('"{}"'.format(f))]
+    return sum(os.path.getsize(p) for p in paths if os.path.exists(p))
+
+def available_memory():
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+
+def default_workers(memory_per_job, threads_per_job=1):
+    cores = max(1, (os.cpu_count() or 1) // threads_per_job)
+    if memory_per_job:
+        cores = min(cores, available_memory() // memory_per_job)
+    return max(1, cores)
+
+def prepare_scratch(directory, storage=STORAGE_DIRECTORY):
+    import tempfile
+    scratch = tempfile.mkdtemp(prefix='.run-', dir=directory)
+    shutil.copyfile(os.path.join(directory, 'stdin'), os.path.join(scratch, 'stdin'))
+    if read_manifest(directory):
+        link_wavefunctions(directory, blob_directory=os.path.join(storage, 'blobs'),
+                           target=scratch)
+    else:
+        # directories cached before the blob store have their own copies
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if WFN_REGEX.match('"{}"'.format(name)) and os.path.isfile(path):
+                try:
+                    os.link(path, os.path.join(scratch, name))
+                except OSError:
+                    shutil.copy2(path, os.path.join(scratch, name))
+    return scratch
+
+def run_job(directory, tonto_exe, storage=STORAGE_DIRECTORY):
+    scratch = prepare_scratch(directory, storage=storage)
+    try:
+        t1 = time.time()
+        with open(os.path.join(scratch, 'terminal'), 'w') as terminal:
+            returncode = subprocess.call([tonto_exe], cwd=scratch,
+                                         stdout=terminal, stderr=subprocess.STDOUT)
+        elapsed = time.time() - t1
+        output = os.path.join(scratch, 'stdout')
+        if returncode != 0 or not os.path.exists(output):
+            shutil.copyfile(os.path.join(scratch, 'terminal'),
+                            os.path.join(directory, 'failed'))
+            return False, elapsed
+        # the cache only ever sees a complete stdout
+        os.replace(output, os.path.join(directory, 'stdout'))
+        if os.path.exists(os.path.join(directory, 'failed')):
+            os.remove(os.path.join(directory, 'failed'))
+        return True, elapsed
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+def run_pending(storage=STORAGE_DIRECTORY, tonto_exe=None, workers=None):
+    import fcntl
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    if not os.path.isdir(storage):
+        print('No {} directory here, nothing to run'.format(storage))
+        return 1
+    lock = open(os.path.join(storage, '.run.lock'), 'w')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        print('Another tonto_hpc.py run is using {}'.format(storage))
+        return 1
+
+    for directory in job_directories(storage):
+        for name in os.listdir(directory):
+            if name.startswith('.run-'):
+                # left behind by an interrupted run
+                shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+    db = open_index(storage)
+    scan_index(db, storage)
+    pending = [d for d in job_directories(storage) if is_pending(d)]
+    # longest jobs first keeps the pool busy until the end
+    pending.sort(key=lambda d: job_cost(d, storage), reverse=True)
+    print('{} pending jobs, running {} at a time'.format(len(pending), workers))
+
+    failures = 0
+    pool = ThreadPoolExecutor(max_workers=workers)
+    try:
+        futures = {pool.submit(run_job, d, tonto_exe, storage): d for d in pending}
+        for i, future in enumerate(as_completed(futures), 1):
+            directory = futures[future]
+            try:
+                ok, elapsed = future.result()
+            except Exception as e:
+                ok, elapsed = False, 0.0
+                print(e)
+            failures += not ok
+            if ok:
+                record_result(db, os.path.basename(directory),
+                              file_contents(os.path.join(directory, 'stdout')),
+                              elapsed=elapsed)
+            else:
+                set_state(db, os.path.basename(directory), 'failed', elapsed=elapsed)
+            print('[{}/{}] {} {} ({:.1f}s)'.format(
+                i, len(pending), os.path.basename(directory),
+                'done' if ok else 'FAILED', elapsed))
+    except KeyboardInterrupt:
+        pool.shutdown(wait=False, cancel_futures=True)
+        print('Interrupted: finished jobs are kept, run again to resume')
+        return 130
+    pool.shutdown()
+    return 1 if failures else 0
+
+
+BUNDLE_PREFIX = 'bundle-'
+RESULTS_SUFFIX = '.results.tar.gz'
+
+ARRAY_HEADERS = {
+    # Torque, as used by the pbs backend of g09wrapper.py
+    'pbs': """#!/bin/bash
+#PBS -N tonto_hpc
+#PBS -t 0-{last}
+#PBS -l nodes=1:ppn={cpus}
+#PBS -l mem={memory}gb
+#PBS -l walltime={walltime}
+cd "$PBS_O_WORKDIR"
+TASK_ID=$PBS_ARRAYID
+""",
+    'pbspro': """#!/bin/bash
+#PBS -N tonto_hpc
+#PBS -J 0-{last}
+#PBS -l select=1:ncpus={cpus}:mem={memory}gb
+#PBS -l walltime={walltime}
+cd "$PBS_O_WORKDIR"
+TASK_ID=$PBS_ARRAY_INDEX
+""",
+    'slurm': """#!/bin/bash
+#SBATCH --job-name=tonto_hpc
+#SBATCH --array=0-{last}
+#SBATCH --nodes=1
+#SBATCH --ntasks=1
+#SBATCH --cpus-per-task={cpus}
+#SBATCH --mem={memory}G
+#SBATCH --time={walltime}
+cd "$SLURM_SUBMIT_DIR"
+TASK_ID=$SLURM_ARRAY_TASK_ID
+""",
+}
+
+ARRAY_BODY = """
+BUNDLE=$(printf '{prefix}%03d' "$TASK_ID")
+mkdir -p "$BUNDLE" && cd "$BUNDLE" || exit 1
+tar xzf "../$BUNDLE.tar.gz" || exit 1
+${{PYTHON:-python}} ../tonto_hpc.py --storage {storage} run -j {cpus} --tonto {tonto}
+find {storage} -mindepth 2 -maxdepth 2 \\( -name stdout -o -name failed \\) -print0 |
+    tar czf "../$BUNDLE{results}" --null -T -
+"""
+
+def balanced_bundles(directories, n_bundles, storage=STORAGE_DIRECTORY):
+    import heapq
+    bundles = [[] for _ in range(n_bundles)]
+    loads = [(0, i) for i in range(n_bundles)]
+    costs = {d: job_cost(d, storage) + 1 for d in directories}
+    # longest processing time first: each job goes to the lightest bundle
+    for directory in sorted(directories, key=costs.get, reverse=True):
+        load, i = heapq.heappop(loads)
+        bundles[i].append(directory)
+        heapq.heappush(loads, (load + costs[directory], i))
+    return [b for b in bundles if b]
+
+def write_bundle(filename, directories, storage=STORAGE_DIRECTORY):
+    import tarfile
+    blobs = os.path.join(storage, 'blobs')
+    arcroot = os.path.basename(os.path.normpath(storage))
+    added = set()
+    tmp = '{}.{}.tmp'.format(filename, os.getpid())
+    with tarfile.open(tmp, 'w:gz') as tar:
+        for directory in directories:
+            arcdir = os.path.join(arcroot, os.path.basename(directory))
+            manifest = read_manifest(directory)
+            names = ['stdin']
+            if manifest:
+                names.append(MANIFEST_FILENAME)
+            else:
+                names.extend(f for f in os.listdir(directory)
+                             if WFN_REGEX.match('"{}"'.format(f)))
+            for name in names:
+                tar.add(os.path.join(directory, name), os.path.join(arcdir, name))
+            # each wavefunction goes into the bundle once, however many
+            # jobs in it refer to it
+            for blob, _ in manifest:
+                if blob not in added:
+                    tar.add(os.path.join(blobs, blob),
+                            os.path.join(arcroot, 'blobs', blob))
+                    added.add(blob)
+    os.replace(tmp, filename)
+
+def pack_pending(output, storage=STORAGE_DIRECTORY, n_bundles=None,
+                 jobs_per_bundle=50, scheduler='slurm', cpus=4,
+                 memory_per_job=2.0, walltime='24:00:00', tonto='tonto'):
+    pending = [d for d in job_directories(storage) if is_pending(d)]
+    if not pending:
+        print('No pending jobs in {}'.format(storage))
+        return 0
+    if n_bundles is None:
+        n_bundles = -(-len(pending) // jobs_per_bundle)
+    bundles = balanced_bundles(pending, n_bundles, storage)
+
+    os.makedirs(output, exist_ok=True)
+    db = open_index(storage)
+    for i, bundle in enumerate(bundles):
+        filename = os.path.join(output, '{}{:03d}.tar.gz'.format(BUNDLE_PREFIX, i))
+        write_bundle(filename, bundle, storage)
+        for directory in bundle:
+            set_state(db, os.path.basename(directory), 'submitted',
+                      bundle=os.path.basename(filename))
+        print('{}: {} jobs'.format(os.path.basename(filename), len(bundle)))
+    shutil.copyfile(os.path.abspath(__file__), os.path.join(output, 'tonto_hpc.py'))
+
+    script = os.path.join(output, 'submit.{}'.format(scheduler))
+    atomic_write(script, (ARRAY_HEADERS[scheduler] + ARRAY_BODY).format(
+        last=len(bundles) - 1, cpus=cpus, walltime=walltime,
+        memory=int(-(-cpus * memory_per_job // 1)), prefix=BUNDLE_PREFIX,
+        storage=os.path.basename(os.path.normpath(storage)), tonto=tonto,
+        results=RESULTS_SUFFIX))
+    command = 'sbatch' if scheduler == 'slurm' else 'qsub'
+    print('Packed {} jobs into {} bundles in {}'.format(len(pending), len(bundles), output))
+    print('Copy it to the cluster and submit with: {} {}'.format(
+        command, os.path.basename(script)))
+    return 0
+
+RESULT_REGEX = re.compile(r'(?:^|/)([0-9a-f]{40})/(stdout|failed)$')
+
+def unpack_results(filenames, storage=STORAGE_DIRECTORY, force=False):
+    import tarfile
+    counts = {'stdout': 0, 'failed': 0, 'skipped': 0, 'unknown': 0}
+    db = open_index(storage)
+    for filename in filenames:
+        with tarfile.open(filename, 'r:*') as tar:
+            for member in tar:
+                m = RESULT_REGEX.search(member.name)
+                if not member.isfile() or m is None:
+                    continue
+                h, kind = m.groups()
+                directory = os.path.join(storage, h)
+                if not os.path.exists(os.path.join(directory, 'stdin')):
+                    counts['unknown'] += 1
+                    continue
+                stdout = os.path.join(directory, 'stdout')
+                if os.path.exists(stdout) and not force:
+                    counts['skipped'] += 1
+                    continue
+                contents = tar.extractfile(member).read()
+                atomic_write(os.path.join(directory, kind), contents, mode='wb')
+                if kind == 'stdout' and os.path.exists(os.path.join(directory, 'failed')):
+                    os.remove(os.path.join(directory, 'failed'))
+                if kind == 'stdout':
+                    record_result(db, h, contents.decode('utf-8', 'replace'))
+                else:
+                    set_state(db, h, 'failed')
+                counts[kind] += 1
+    print('{stdout} results merged, {failed} failed, {skipped} already present, '
+          '{unknown} not in this cache'.format(**counts))
+    return 0
+
+def print_status(storage=STORAGE_DIRECTORY, rescan=False, list_state=None):
+    new = not os.path.exists(os.path.join(storage, INDEX_FILENAME))
+    db = open_index(storage)
+    if rescan or new:
+        scan_index(db, storage)
+    if list_state:
+        for (name,) in db.execute('SELECT directory FROM jobs WHERE state = ? '
+                                  'ORDER BY directory', (list_state,)):
+            print(os.path.join(storage, name))
+        return 0
+    counts = dict(db.execute('SELECT state, count(*) FROM jobs GROUP BY state'))
+    print('{}: {} jobs'.format(storage, sum(counts.values())))
+    for state in JOB_STATES:
+        print('  {:<10s} {:>8d}'.format(state, counts.get(state, 0)))
+    n, total = db.execute('SELECT count(elapsed), sum(elapsed) FROM jobs '
+                          'WHERE state = ?', ('done',)).fetchone()
+    if n:
+        print('tonto time {:.1f} h in {} timed jobs, {:.1f} min per job'.format(
+            total / 3600, n, total / n / 60))
+    for bundle, count in db.execute('SELECT bundle, count(*) FROM jobs WHERE state = ? '
+                                    'GROUP BY bundle ORDER BY bundle', ('submitted',)):
+        print('  {} jobs waiting on {}'.format(count, bundle))
+    return 0
+
+def export_energies(storages, output=None):
+    import csv
+    f = open(output, 'w', newline='') if output else sys.stdout
+    writer = csv.writer(f)
+    writer.writerow(('storage', 'directory') + tuple('e_' + c for c in ENERGY_COLUMNS))
+    for storage in storages:
+        if os.path.isdir(os.path.join(storage, STORAGE_DIRECTORY)):
+            storage = os.path.join(storage, STORAGE_DIRECTORY)
+        new = not os.path.exists(os.path.join(storage, INDEX_FILENAME))
+        db = open_index(storage)
+        if new:
+            scan_index(db, storage)
+        # results recorded before energies were parsed at ingest
+        for (name,) in db.execute('SELECT directory FROM jobs WHERE state = ? AND directory '
+                                  'NOT IN (SELECT directory FROM energies)', ('done',)).fetchall():
+            record_result(db, name, file_contents(os.path.join(storage, name, 'stdout')))
+        rows = db.execute('SELECT directory, {} FROM energies JOIN jobs USING (directory) '
+                          'WHERE state = ? ORDER BY directory'.format(', '.join(ENERGY_COLUMNS)),
+                          ('done',))
+        writer.writerows((storage,) + row for row in rows)
+    if output:
+        f.close()
+    return 0
+
+def collect_garbage(storage=STORAGE_DIRECTORY, dry_run=False):
+    import fcntl
+    lock = open(os.path.join(storage, '.run.lock'), 'w')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        print('A tonto_hpc.py run is using {}, not collecting garbage'.format(storage))
+        return 1
+    remove = []
+    referenced = set()
+    for name in sorted(os.listdir(storage)):
+        directory = os.path.join(storage, name)
+        if not os.path.isdir(directory) or name in ('blobs', 'canonical'):
+            continue
+        if not os.path.exists(os.path.join(directory, 'stdin')):
+            # interrupted before the input was written
+            if not os.path.exists(os.path.join(directory, 'stdout')):
+                remove.append(directory)
+            continue
+        referenced.update(blob for blob, _ in read_manifest(directory))
+        remove.extend(os.path.join(directory, f) for f in os.listdir(directory)
+                      if f.startswith('.run-') or f.endswith('.tmp'))
+    blobs = os.path.join(storage, 'blobs')
+    if os.path.isdir(blobs):
+        remove.extend(os.path.join(blobs, b) for b in sorted(os.listdir(blobs))
+                      if b not in referenced and b != 'digests')
+
+    for path in remove:
+        print('remove {}'.format(path))
+        if dry_run:
+            continue
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            os.remove(path)
+    if dry_run:
+        return 0
+
+    db = open_index(storage)
+    missing = scan_index(db, storage)
+    canonical = os.path.join(storage, 'canonical')
+    if os.path.isdir(canonical):
+        for key in os.listdir(canonical):
+            index = os.path.join(canonical, key)
+            names = file_contents(index).split()
+            kept = [n for n in names if os.path.isdir(os.path.join(storage, n))]
+            if not kept:
+                os.remove(index)
+            elif kept != names:
+                atomic_write(index, ''.join(n + '\n' for n in kept))
+    print('{} files removed, {} stale index entries dropped'.format(len(remove), missing))
+    return 0
+
+def command_line(argv):
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog='tonto_hpc.py',
+        description='Manage cached interaction energy jobs. Run without '
+                    'arguments, this script behaves like tonto.')
+    parser.add_argument('--storage', default=STORAGE_DIRECTORY,
+                        help='Cache directory written by tonto_hpc.py')
+    subparsers = parser.add_subparsers(dest='command')
+
+    p = subparsers.add_parser('run', help='Run all pending jobs in the cache locally')
+    p.add_argument('-j', '--jobs', type=int, default=None,
+                   help='Number of concurrent tonto jobs (default: from cores and memory)')
+    p.add_argument('--memory-per-job', type=float, default=2.0,
+                   help='Memory to allow per tonto job in GB')
+    p.add_argument('--tonto', default=None,
+                   help='tonto executable (default: tonto on the PATH)')
+
+    p = subparsers.add_parser('pack', help='Bundle pending jobs for a PBS/Slurm job array')
+    p.add_argument('-o', '--output', default='tonto_hpc_bundles',
+                   help='Directory to write bundles and the submit script to')
+    p.add_argument('--scheduler', choices=sorted(ARRAY_HEADERS), default='slurm')
+    p.add_argument('--bundles', type=int, default=None,
+                   help='Number of bundles (array tasks)')
+    p.add_argument('--jobs-per-bundle', type=int, default=50,
+                   help='Bundle size used when --bundles is not given')
+    p.add_argument('--jobs-per-node', type=int, default=4,
+                   help='Concurrent tonto jobs (cores) per array task')
+    p.add_argument('--memory-per-job', type=float, default=2.0,
+                   help='Memory to request per tonto job in GB')
+    p.add_argument('--walltime', default='24:00:00')
+    p.add_argument('--tonto', default='tonto',
+                   help='tonto executable on the cluster')
+
+    p = subparsers.add_parser('unpack', help='Merge results returned from pack bundles')
+    p.add_argument('results', nargs='+', help='*{} files'.format(RESULTS_SUFFIX))
+    p.add_argument('--force', action='store_true',
+                   help='Overwrite stdout files already in the cache')
+
+    p = subparsers.add_parser('status', help='Summarise the state of cached jobs')
+    p.add_argument('--rescan', action='store_true',
+                   help='Update the index from the cache directories first')
+    p.add_argument('--list', choices=JOB_STATES, default=None,
+                   help='List the job directories in this state')
+
+    p = subparsers.add_parser('gc', help='Remove orphaned cache entries and blobs')
+    p.add_argument('-n', '--dry-run', action='store_true',
+                   help='Only print what would be removed')
+
+    p = subparsers.add_parser('energies', help='Export interaction energies as CSV')
+    p.add_argument('storages', nargs='*',
+                   help='Cache directories, or directories containing {} '
+                        '(default: --storage)'.format(STORAGE_DIRECTORY))
+    p.add_argument('-o', '--output', default=None, help='CSV file (default: stdout)')
+
+    args = parser.parse_args(argv)
+    if args.command == 'energies':
+        return export_energies(args.storages or [args.storage], args.output)
+    if args.command == 'status':
+        return print_status(args.storage, rescan=args.rescan, list_state=args.list)
+    if args.command == 'gc':
+        return collect_garbage(args.storage, dry_run=args.dry_run)
+    if args.command == 'pack':
+        return pack_pending(args.output, args.storage, n_bundles=args.bundles,
+                            jobs_per_bundle=args.jobs_per_bundle,
+                            scheduler=args.scheduler, cpus=args.jobs_per_node,
+                            memory_per_job=args.memory_per_job,
+                            walltime=args.walltime, tonto=args.tonto)
+    if args.command == 'unpack':
+        return unpack_results(args.results, args.storage, force=args.force)
+    if args.command == 'run':
+        tonto_exe = args.tonto or 'tonto'
+        if os.path.dirname(tonto_exe):
+            tonto_exe = tonto_exe if is_executable(tonto_exe) else None
+        else:
+            tonto_exe = which(tonto_exe)
+        if tonto_exe is None:
+            parser.error('Could not find tonto executable {}'.format(args.tonto or 'tonto'))
+        # jobs run from their own scratch directories
+        tonto_exe = os.path.abspath(tonto_exe)
+        workers = args.jobs or default_workers(int(args.memory_per_job * 1024 ** 3))
+        return run_pending(args.storage, tonto_exe=tonto_exe, workers=workers)
+    parser.print_help()
+    return 1
 
+SUBCOMMANDS = ('run', 'pack', 'unpack', 'status', 'gc', 'energies')
 
 def main():
+    if len(sys.argv) > 1 and (sys.argv[1] in SUBCOMMANDS or sys.argv[1].startswith('-')):
+        sys.exit(command_line(sys.argv[1:]))
     input_filename = 'stdin'
     output_filename = 'stdout'
     input_contents = file_contents(input_filename)